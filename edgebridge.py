@@ -25,25 +25,70 @@
 VERSION = '1.2318101200'
 
 import http.server
+import http.client
+import http.cookiejar
+import http
+import ssl
+import io
 import datetime
 import time
+import bisect
+import heapq
 import socket
+import select
+import threading
+import queue
+import atexit
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
-import requests
+import importlib
+import urllib.parse
 import os
 import sys
 import platform
 import configparser
 import json
 import ipaddress
+import base64
+import email.utils
+from collections import OrderedDict, deque
+
+
+class lazymodule(object):
+    
+    # Stands in for a module that is slow to import and that some configurations never use (requests
+    # with the asyncio engine, asyncio with the threaded one), importing it when one of its attributes
+    # is first used.  The real module then replaces the stand-in under its module-level name.
+    
+    def __init__(self, name):
+        
+        self.name = name
+        
+    def load(self):
+        
+        module = importlib.import_module(self.name)
+        globals()[self.name] = module
+        return module
+        
+    def __getattr__(self, attr):
+        
+        return getattr(self.load(), attr)
+
+
+requests = lazymodule('requests')
+urllib3 = lazymodule('urllib3')
+asyncio = lazymodule('asyncio')
+tracemalloc = lazymodule('tracemalloc')
 
-registrations = []
-hubsenderrors = {}
 regdeletelist = []
+reglock = threading.RLock()             # guards registrations & regdeletelist
 
 HTTP_OK = 200
 CONFIGFILENAME = 'edgebridge.cfg'
 REGSFILENAME = '.registrations'
+SPOOLFILENAME = '.hubspool'
+JOURNALSUFFIX = '.journal'
 LOGFILE = 'edgebridge.log'
 MAXPORT = 65535
 TOKEN_LENGTH = 36
@@ -51,15 +96,84 @@ DEFAULT_SERVERPORT = 8088
 DEFAULT_ST_TOKEN = ''
 SERVER_PORT = DEFAULT_SERVERPORT
 SMARTTHINGS_TOKEN = DEFAULT_ST_TOKEN
-FWTIMEOUT = 5
+DEFAULT_FWTIMEOUT = 5
+FWTIMEOUT = DEFAULT_FWTIMEOUT           # read timeout for forwards
+DEFAULT_FW_CONNECT_TIMEOUT = 3
+FW_CONNECT_TIMEOUT = DEFAULT_FW_CONNECT_TIMEOUT
+MAX_FORWARD_DEADLINE = 120
+FORWARD_RETRY_BACKOFF = 0.05
+FORWARD_RETRY_STATUSES = (502, 503, 504)
+DEFAULT_SERVER_THREADS = 8
+SERVER_THREADS = DEFAULT_SERVER_THREADS
+DEFAULT_POOL_SIZE = 8
+DEFAULT_POOL_IDLE = 60
+DEFAULT_SERVER_ENGINE = 'threaded'
+SERVER_ENGINE = DEFAULT_SERVER_ENGINE
+CLIENT_TIMEOUT = 30
+DEFAULT_KEEPALIVE_TIMEOUT = 5
+KEEPALIVE_TIMEOUT = DEFAULT_KEEPALIVE_TIMEOUT
+DEFAULT_KEEPALIVE_REQUESTS = 100
+KEEPALIVE_REQUESTS = DEFAULT_KEEPALIVE_REQUESTS
+KEEPALIVE_POLL = 0.25
+DEFAULT_HUB_TIMEOUT = 5
+HUB_TIMEOUT = DEFAULT_HUB_TIMEOUT
+HUB_ACK_IMMEDIATE = False
+HUB_THREADS = 8
+DEFAULT_HUB_QUEUE_DEPTH = 100
+DEFAULT_HUB_RETRIES = 3
+DEFAULT_HUB_BACKOFF = 1
+DEFAULT_HUB_FAILURES = 3
+DEFAULT_HUB_OPEN_SECS = 30
+DEFAULT_HUB_SCRUB_SECS = 3600
+SPOOL_COMPACT_MIN = 64                  # hub spool lines written before it is worth rewriting
+FORWARD_STREAMING = False
+STREAM_CHUNK = 65536
+SERVER_METHODS = ('GET', 'POST', 'PUT', 'DELETE')      # the do_ methods of myHTTPRequestHandler
+BULK_OPS = ('add', 'replace', 'delete')
+BULK_FIELDS = frozenset(('op', 'devaddr', 'hubaddr', 'edgeid', 'batch', 'window'))
+REGS_LOAD_BATCH = 65536                 # bytes of registration file parsed at a time at startup
+DEFAULT_MAX_BODY_SIZE = 1048576
+MAX_BODY_SIZE = DEFAULT_MAX_BODY_SIZE
+LOG_BODY_MAX = 1024                     # body bytes shown in debug logging
+FORWARD_COALESCING = True
+DEFAULT_CACHE_TTL = 10
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_RATE_BURST = 10
+BATCH_MODES = ('latest', 'array')
+DEFAULT_BATCH_WINDOW = 1000             # milliseconds
+MAX_BATCH_WINDOW = 60000
+DEBUG_PROFILE = False
+DEFAULT_PROFILE_SECONDS = 5
+MAX_PROFILE_SECONDS = 60
+PROFILE_INTERVAL = 0.005
+# Innermost frames of a thread that is waiting rather than running
+PROFILE_IDLE = frozenset(('select', 'poll', 'wait', 'get', 'sleep', 'accept', 'acquire', 'readinto', 'recv', 'recv_into', '_worker'))
+BATCH_MAX_MESSAGES = 100
+RATE_LIMIT_KEYS = 1024
 
 
 class logger(object):
     
-    def __init__(self, toconsole, tofile, fname, append):
+    # Messages are queued by the request threads and written out in batches by a background
+    # writer thread, so request latency does not depend on console or disk speed.  The queue is
+    # bounded; when it is full, messages are dropped and counted rather than blocking the caller.
+    # The log file is kept open and rotated by size and/or age, keeping 'backups' old files.
+    
+    DEBUG = 10
+    INFO = 20
+    WARN = 30
+    ERROR = 40
+    LEVELS = {'debug': DEBUG, 'info': INFO, 'warn': WARN, 'error': ERROR}
+    
+    def __init__(self, toconsole, tofile, fname, append, maxbytes=0, rotatesecs=0, backups=3, queuesize=10000, level=INFO):
     
         self.toconsole = toconsole
         self.savetofile = tofile
+        self.maxbytes = maxbytes
+        self.rotatesecs = rotatesecs
+        self.backups = backups
+        self.dropped = 0
+        self.file = None
 
         self.os = platform.system()
         if self.os == 'Windows':
@@ -72,78 +186,444 @@ class logger(object):
                     os.remove(fname)
                 except:
                     pass
+                    
+        self.queue = queue.Queue(maxsize=queuesize)
+        self.writer = None
+        if toconsole or tofile:
+            self.writer = threading.Thread(target=self.__writer, name='logwriter', daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+            
+        # Levels are decided once here: disabled levels are bound to a no-op, and callers can test
+        # 'debugging' before building anything expensive.  Messages take %-style arguments, which
+        # are only formatted for enabled levels.
+        
+        self.level = level if self.writer else self.ERROR + 1
+        self.debugging = self.level <= self.DEBUG
+        for name, lvl in (('debug', self.DEBUG), ('info', self.INFO), ('warn', self.WARN), ('error', self.ERROR)):
+            if self.level > lvl:
+                setattr(self, name, self.__discard)
+        if not self.writer:
+            self.hilite = self.__discard
+            
+    def __openfile(self):
+        
+        try:
+            self.file = open(self.filename, 'a')
+            self.opened = time.monotonic()
+        except OSError as err:
+            print (f'\033[31mCannot open log file {self.filename}: {err}\033[0m')
+            self.savetofile = False
+            
+    def __rotate(self):
+        
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.filename}.{i}'):
+                os.replace(f'{self.filename}.{i}', f'{self.filename}.{i+1}')
+        if self.backups > 0:
+            os.replace(self.filename, f'{self.filename}.1')
+        else:
+            os.remove(self.filename)
+        self.__openfile()
+            
+    def __savetofile(self, batch):
+        
+        if self.file is None:
+            self.__openfile()
+            if self.file is None:
+                return
+        
+        self.file.write(''.join(f'{stamp}  {msg}\n' for stamp, color, msg in batch))
+        self.file.flush()
+        
+        try:
+            if (self.maxbytes and self.file.tell() >= self.maxbytes) or \
+               (self.rotatesecs and time.monotonic() - self.opened >= self.rotatesecs):
+                self.__rotate()
+        except OSError as err:
+            print (f'\033[31mLog file rotation failed: {err}\033[0m')
+            
+    def __writer(self):
+        
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < 1000:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+                
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+                
+            if batch:
+                if self.toconsole:
+                    print ('\n'.join(f'\033[33m{stamp}  {color}{msg}\033[0m' for stamp, color, msg in batch), flush=True)
+                if self.savetofile:
+                    self.__savetofile(batch)
+                    
+            if stop:
+                return
+    
+    def __outputmsg(self, color, msg, args):
+        
+        if args:
+            msg = msg % args
+        try:
+            self.queue.put_nowait((time.strftime("%c"), color, msg))
+        except queue.Full:
+            self.dropped += 1
+            
+    def __discard(self, msg, *args):
+        pass
+                
+    def close(self):
+        
+        # Drain anything still queued, then stop the writer
+        
+        if self.writer and self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+            if self.dropped:
+                print (f'{self.dropped} log message(s) dropped')
+        if self.file:
+            self.file.close()
+            self.file = None
+    
+    def info(self, msg, *args):
+        self.__outputmsg('\033[96m', msg, args)
+        
+    def warn(self, msg, *args):
+        self.__outputmsg('\033[93m', msg, args)
+        
+    def error(self, msg, *args):
+        self.__outputmsg('\033[91m', msg, args)
+        
+    def hilite(self, msg, *args):
+        self.__outputmsg('\033[97m', msg, args)
+        
+    def debug(self, msg, *args):
+        self.__outputmsg('\033[37m', msg, args)
+
+
+countingAdapter = None
+
+
+def counting_adapter(**kwargs):
+    
+    # HTTPAdapter that counts the TCP connections its pools actually open; urllib3's own
+    # num_connections misses sockets that are silently re-opened on an existing connection object.
+    # The class is defined on first use, as requests is only imported once something is sent with it.
+    
+    global countingAdapter
+    if countingAdapter is None:
+        
+        class countingAdapter(requests.adapters.HTTPAdapter):
+            
+            def __init__(self, **kwargs):
+                
+                self.connects = 0
+                self.countlock = threading.Lock()
+                super().__init__(**kwargs)
+                
+            def init_poolmanager(self, *args, **kwargs):
+                
+                super().init_poolmanager(*args, **kwargs)
+                adapter = self
+                
+                class countingHTTPConnection(urllib3.connection.HTTPConnection):
+                    def connect(self):
+                        with adapter.countlock:
+                            adapter.connects += 1
+                        super().connect()
+                
+                class countingHTTPSConnection(urllib3.connection.HTTPSConnection):
+                    def connect(self):
+                        with adapter.countlock:
+                            adapter.connects += 1
+                        super().connect()
+                
+                class countingHTTPConnectionPool(urllib3.HTTPConnectionPool):
+                    ConnectionCls = countingHTTPConnection
+            
+                class countingHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+                    ConnectionCls = countingHTTPSConnection
             
-    def __savetofile(self, msg):
+                self.poolmanager.pool_classes_by_scheme = {'http': countingHTTPConnectionPool,
+                                                           'https': countingHTTPSConnectionPool}
+                
+    return countingAdapter(**kwargs)
+
+
+class sessionpool(object):
+    
+    # Keep-alive outbound HTTP sessions, one per scheme://host:port, so that forwards and hub
+    # deliveries reuse TCP (and TLS) connections instead of opening a new one per message.
+    # Sessions idle for longer than idle_timeout seconds are closed along with their connections.
+    # A session is shared by every Edge driver and device, so it keeps no cookies between requests.
+    
+    def __init__(self, maxsize, idle_timeout):
+        
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.sessions = {}                  # key -> [session, adapter, last used, requests in flight]
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retired = 0                    # connections opened by sessions that have since expired
+        
+    def __key(self, url):
+        
+        parts = urllib.parse.urlsplit(url)
+        return f'{parts.scheme}://{parts.netloc}'.lower()
         
-        with open(self.filename, 'a') as f:
-            f.write(f'{time.strftime("%c")}  {msg}\n')
+    def __newentry(self, now):
+        
+        session = requests.Session()
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = counting_adapter(pool_connections=1, pool_maxsize=self.maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return [session, adapter, now, 0]
+        
+    def __expire(self, now):
+        
+        for key in [key for key, entry in self.sessions.items()
+                    if entry[3] == 0 and now - entry[2] > self.idle_timeout]:
+            session, adapter = self.sessions.pop(key)[:2]
+            self.retired += adapter.connects
+            session.close()
     
-    def __outputmsg(self, colormsg, plainmsg):
+    def request(self, method, url, **kwargs):
+        
+        key = self.__key(url)
         
-        if self.toconsole:
-            print (colormsg)
-        if self.savetofile:
-            self.__savetofile(plainmsg)
+        with self.lock:
+            now = time.monotonic()
+            self.__expire(now)
+            entry = self.sessions.get(key)
+            if entry is None:
+                entry = self.__newentry(now)
+                self.sessions[key] = entry
+            entry[2] = now
+            entry[3] += 1
+            self.requests += 1
+            
+        try:
+            return entry[0].request(method, url, **kwargs)
+        finally:
+            with self.lock:
+                entry[2] = time.monotonic()
+                entry[3] -= 1
+                
+    def stats(self):
+        
+        with self.lock:
+            conns = self.retired + sum(entry[1].connects for entry in self.sessions.values())
+            return {'hosts': len(self.sessions), 'hits': max(self.requests - conns, 0), 'misses': conns}
+            
+    def close(self):
+        
+        with self.lock:
+            for entry in self.sessions.values():
+                entry[0].close()
+            self.sessions.clear()
+
+
+outbound = sessionpool(DEFAULT_POOL_SIZE, DEFAULT_POOL_IDLE)
+hubpool = ThreadPoolExecutor(max_workers=HUB_THREADS, thread_name_prefix='hubdelivery')
+
+
+class metrics(object):
+    
+    # Request counters and latency histograms, rendered in Prometheus text format by /api/metrics.
+    # Recording is a few dict updates under one lock, cheap enough to leave on under load.
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
     
-    def info(self, msg):
-        colormsg = f'\033[33m{time.strftime("%c")}  \033[96m{msg}\033[0m'
-        self.__outputmsg(colormsg, msg)
+    HISTOGRAMS = {'edgebridge_request_duration_seconds': 'Total time to handle a request, by endpoint',
+                  'edgebridge_forward_upstream_seconds': 'Time waiting on the internet server for a forwarded request',
+                  'edgebridge_hub_delivery_seconds': 'Time to deliver a device message to an Edge hub'}
+    
+    def __init__(self):
+        
+        self.lock = threading.Lock()
+        self.requests = {}                  # (endpoint, method) -> count
+        self.responses = {}                 # (endpoint, status) -> count
+        self.histograms = {}                # (name, endpoint) -> [bucket counts..., +Inf count, sum, count]
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.connections_total = 0
+        self.reuses = 0
+        self.started = time.time()
+        
+    def __observe(self, name, endpoint, seconds):
+        
+        # called with self.lock held
+        hist = self.histograms.get((name, endpoint))
+        if hist is None:
+            hist = self.histograms[(name, endpoint)] = [0] * (len(self.BUCKETS) + 3)
+        hist[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
+        
+    def request(self, endpoint, method, status, seconds, bytes_in, bytes_out):
+        
+        with self.lock:
+            key = (endpoint, method)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            key = (endpoint, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.__observe('edgebridge_request_duration_seconds', endpoint, seconds)
+            
+    def forward_upstream(self, seconds):
+        
+        with self.lock:
+            self.__observe('edgebridge_forward_upstream_seconds', None, seconds)
+            
+    def hub_delivery(self, seconds):
+        
+        with self.lock:
+            self.__observe('edgebridge_hub_delivery_seconds', None, seconds)
+            
+    def connection_opened(self):
+        
+        with self.lock:
+            self.connections += 1
+            self.connections_total += 1
+            
+    def connection_closed(self):
+        
+        with self.lock:
+            self.connections -= 1
+            
+    def connection_reused(self):
+        
+        with self.lock:
+            self.reuses += 1
+            
+    def render(self, extra=()):
         
-    def warn(self, msg):
-        colormsg = f'\033[33m{time.strftime("%c")}  \033[93m{msg}\033[0m'
-        self.__outputmsg(colormsg, msg)
+        # extra: (name, type, help, [(labels dict, value), ...]) for gauges and counters kept elsewhere
         
-    def error(self, msg):
-        colormsg = f'\033[33m{time.strftime("%c")}  \033[91m{msg}\033[0m'
-        self.__outputmsg(colormsg, msg)
+        def labels(pairs):
+            pairs = [(k, v) for k, v in pairs if v is not None]
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}' if pairs else ''
         
-    def hilite(self, msg):
-        colormsg = f'\033[33m{time.strftime("%c")}  \033[97m{msg}\033[0m'
-        self.__outputmsg(colormsg, msg)
+        out = []
+        def family(name, kind, help, samples):
+            out.append(f'# HELP {name} {help}')
+            out.append(f'# TYPE {name} {kind}')
+            for pairs, value in samples:
+                out.append(f'{name}{labels(pairs)} {value}')
         
-    def debug(self, msg):
-        if len(sys.argv) > 1:
-            if sys.argv[1] == '-d':
-                colormsg = f'\033[33m{time.strftime("%c")}  \033[37m{msg}\033[0m'
-                self.__outputmsg(colormsg, msg)
+        with self.lock:
+            family('edgebridge_requests_total', 'counter', 'Requests received, by endpoint and method',
+                   [((('endpoint', e), ('method', m)), n) for (e, m), n in sorted(self.requests.items())])
+            family('edgebridge_responses_total', 'counter', 'Responses sent, by endpoint and HTTP status',
+                   [((('endpoint', e), ('status', c)), n) for (e, c), n in sorted(self.responses.items())])
+            family('edgebridge_received_bytes_total', 'counter', 'Request body bytes received', [((), self.bytes_in)])
+            family('edgebridge_sent_bytes_total', 'counter', 'Response body bytes sent', [((), self.bytes_out)])
+            family('edgebridge_active_connections', 'gauge', 'Client connections currently open', [((), self.connections)])
+            family('edgebridge_connections_total', 'counter', 'Client connections accepted', [((), self.connections_total)])
+            family('edgebridge_connection_reuses_total', 'counter', 'Requests received on an already used (kept-alive) connection',
+                   [((), self.reuses)])
+            family('edgebridge_start_time_seconds', 'gauge', 'Unix time the server started', [((), round(self.started, 3))])
+            
+            for name, help in self.HISTOGRAMS.items():
+                out.append(f'# HELP {name} {help}')
+                out.append(f'# TYPE {name} histogram')
+                for (hname, endpoint), hist in sorted(self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+                    if hname != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.BUCKETS + ('+Inf',), hist):
+                        cumulative += count
+                        out.append(f'{name}_bucket{labels((("endpoint", endpoint), ("le", bound)))} {cumulative}')
+                    out.append(f'{name}_sum{labels((("endpoint", endpoint),))} {round(hist[-2], 6)}')
+                    out.append(f'{name}_count{labels((("endpoint", endpoint),))} {hist[-1]}')
+                    
+        for name, kind, help, samples in extra:
+            family(name, kind, help, samples)
+            
+        return '\n'.join(out) + '\n'
+
+
+reqmetrics = metrics()
+
+
+SERVER_HEADER = 'edgeBridge'
+STATIC_HEADERS = f'Server: {SERVER_HEADER}\r\n'.encode('latin-1')
+httpdate = (0, '')
+
+
+def http_date():
+
+    # Date header value; formatted at most once a second rather than per response
+    
+    global httpdate
+    
+    now = int(time.time())
+    stamp, value = httpdate
+    if stamp != now:
+        value = email.utils.formatdate(now, usegmt=True)
+        httpdate = (now, value)
+    return value
 
 
-def http_response(server, code, responsetosend):
+def http_response(server, code, responsetosend, contenttype='text/xml; charset="utf-8"'):
+    
+    # Returns the number of body bytes sent.  Server and Date headers come from send_response.
     
     try:
+        body = responsetosend.encode('utf-8')
         server.send_response(code)
-        if len(responsetosend) > 0:
-            server.send_header("Content-Type", 'text/xml; charset="utf-8"')
-            server.send_header("Content-Length", str(len(bytes(responsetosend, 'UTF-8'))))
-        server.send_header("Date", datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT"))
-        server.send_header("Server", 'edgeBridge')
-        
+        if body:
+            server.send_header("Content-Type", contenttype)
+        server.send_header("Content-Length", str(len(body)))       # always, for keep-alive
         server.end_headers()
-                
-        server.wfile.write(bytes(responsetosend, 'UTF-8'))
+        server.wfile.write(body)
+        server.bytes_out = len(body)
         log.debug ('Response sent')
+        return len(body)
     except:
-        log.error (f'HTTP Send error sending response: {responsetosend}')
+        log.error ('HTTP Send error sending response: %s', responsetosend)
+        return 0
     
 
-def build_headers(server, path):
+# Request headers not passed on to the forward URL: replaced below, or hop-by-hop (the body is
+# re-framed by the outbound request)
+FORWARD_IGNORED_HEADERS = frozenset(('user-agent', 'host', 'te', 'connection', 'keep-alive', 'transfer-encoding',
+                                     'x-edgebridge-timeout'))
 
-    headers = {}
 
-    ignored = ['user-agent', 'host', 'te', 'connection']
+def build_headers(server):
+
+    # server.target is the forward URL, already split by forward_url
+
+    headers = {}
+    authorization = accept = False
 
     for key, value in server.headers.items():
-        if key.lower() not in ignored:
-            headers[key] = value
+        lkey = key.lower()
+        if lkey in FORWARD_IGNORED_HEADERS:
+            continue
+        if lkey == 'authorization':
+            authorization = True
+        elif lkey == 'accept':
+            accept = True
+        headers[key] = value
 
-    if 'api.smartthings.com' in path:
-        if 'authorization' not in map(str.lower, server.headers.keys()):
-            if len(SMARTTHINGS_TOKEN) > 0:
-                headers['Authorization'] = SMARTTHINGS_TOKEN
+    if not authorization and SMARTTHINGS_TOKEN and server.target.hostname == 'api.smartthings.com':
+        headers['Authorization'] = SMARTTHINGS_TOKEN
         
-    headers['Host'] = path.split('//')[1].split('/')[0]
+    headers['Host'] = server.target.netloc.rpartition('@')[2]
     
-    if 'accept' not in map(str.lower, server.headers.keys()):
+    if not accept:
         headers['Accept'] = '*/*'
         
     headers['User-Agent'] = 'SmartThings Edge Hub'
@@ -155,368 +635,3068 @@ def build_headers(server, path):
     return headers
     
 
-def proc_forward (server, method, path, arg):
-
-    headers = {}
-
-    if arg.startswith('url='):
-        url = path[path.index('url=')+4:]
-        log.info (f'Sending {method} to {url}')
+class responsecache(object):
+    
+    # Opt-in cache of GET forward responses, keyed by URL plus the request headers that change the
+    # response.  Cache-Control/Expires set the lifetime when the upstream provides them; otherwise
+    # default_ttl applies.  Expired entries that have an ETag or Last-Modified are kept so they can be
+    # revalidated with a conditional request; the least recently used entry is evicted when full.
+    
+    KEYHEADERS = ('authorization', 'accept', 'accept-language')
+    CONDITIONALS = ('if-none-match', 'if-modified-since')
+    
+    def __init__(self, default_ttl, maxsize):
         
-        headers = build_headers(server, path)
-                
-        log.debug (f'Headers: {headers}')
-        if server.data_bytes:
-            log.debug (f'Body: {server.data_bytes.decode("utf-8")}')
+        self.default_ttl = default_ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()        # key -> {'text', 'expires', 'etag', 'modified'}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
         
-        try:
-            lc_method = method.lower()
-            if lc_method in ['post', 'put', 'get']:
-                r = getattr(requests, lc_method)(url, data=server.data_bytes, headers=headers, timeout=FWTIMEOUT)
+    def key(self, method, url, headers):
+        
+        # Returns None for requests that must not be served from cache
+        
+        if method.lower() != 'get':
+            return None
+        lcheaders = {name.lower(): value for name, value in headers.items()}
+        if any(name in lcheaders for name in self.CONDITIONALS):
+            return None                     # the Edge driver is doing its own revalidation
+        return (url,) + tuple(lcheaders.get(name, '') for name in self.KEYHEADERS)
+        
+    def lookup(self, key):
+        
+        # Returns (entry, fresh); a stale entry is only returned if it can be revalidated
+        
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self.entries.move_to_end(key)
+            if time.monotonic() < entry['expires']:
+                self.hits += 1
+                return entry, True
+            if entry['etag'] or entry['modified']:
+                return entry, False
+            del self.entries[key]
+            self.misses += 1
+            return None, False
             
-            #if method in ['post', 'Post', 'POST']:
-            #    r = requests.post(url, data=server.data_bytes, headers=headers, timeout=FWTIMEOUT)
-            #elif method in ['put', 'Put', 'PUT']:
-            #    r = requests.put(url, data=server.data_bytes, headers=headers, timeout=FWTIMEOUT)
-            #elif method in ['get', 'Get', 'GET']:
-            #    r = requests.get(url, data=server.data_bytes, headers=headers, timeout=FWTIMEOUT)
-        except requests.Timeout:
-            log.error ("Internet request timed out")
-            http_response(server, 502, "")
+    def conditional_headers(self, entry):
+        
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['modified']:
+            headers['If-Modified-Since'] = entry['modified']
+        return headers
+        
+    def __lifetime(self, rheaders):
+        
+        # Seconds the response may be served from cache, or None if it must not be stored
+        
+        directives = {}
+        for part in rheaders.get('Cache-Control', '').split(','):
+            name, _, value = part.strip().partition('=')
+            directives[name.lower()] = value.strip('"')
+            
+        if 'no-store' in directives or rheaders.get('Vary', '').strip() == '*':
+            return None
+        if 'no-cache' in directives:
+            return 0
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                try:
+                    return max(int(directives[name]), 0)
+                except ValueError:
+                    pass
+        if 'Expires' in rheaders:
+            try:
+                expires = email.utils.parsedate_to_datetime(rheaders['Expires'])
+                return max((expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+            except (TypeError, ValueError):
+                return 0
+        return self.default_ttl
+        
+    def store(self, key, rheaders, text):
+        
+        lifetime = self.__lifetime(rheaders)
+        etag = rheaders.get('ETag')
+        modified = rheaders.get('Last-Modified')
+        if lifetime is None or (lifetime == 0 and not (etag or modified)):
             return
             
-        if r.status_code == HTTP_OK:
+        with self.lock:
+            self.entries[key] = {'text': text, 'expires': time.monotonic() + lifetime, 'etag': etag, 'modified': modified}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+                
+    def refresh(self, key, entry, rheaders):
+        
+        # Upstream answered 304 Not Modified: the entry is good for another lifetime
+        
+        lifetime = self.__lifetime(rheaders)
+        with self.lock:
+            self.revalidated += 1
+            if lifetime is None:
+                self.entries.pop(key, None)
+            else:
+                entry['expires'] = time.monotonic() + lifetime
+                
+    def stats(self):
+        
+        with self.lock:
+            lookups = self.hits + self.revalidated + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'revalidated': self.revalidated,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'hit_ratio': round((self.hits + self.revalidated) / lookups, 3) if lookups else 0}
+
+
+fwcache = None                          # responsecache, when forward_cache is enabled
+
+
+class singleflight(object):
+    
+    # Lets identical concurrent GET forwards share one upstream request: the first caller for a key
+    # makes the request, and callers arriving while it is in flight wait for and get the same result
+    # (or exception).  do() is for the threaded engine, async_do() for the asyncio engine's loop.
+    # A waiter gives up at its own deadline (time.monotonic()), which is not part of the key.
+    
+    def __init__(self):
+        
+        self.calls = {}                     # key -> {'event', 'result', 'error'}
+        self.futures = {}                   # key -> asyncio.Future
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+        
+    @staticmethod
+    def key(method, url, headers):
+        
+        if method.lower() != 'get':
+            return None
+        return (url, tuple(sorted((name.lower(), value) for name, value in headers.items())))
+        
+    def do(self, key, fn, deadline=None):
+        
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+                self.leaders += 1
+            else:
+                self.shared += 1
+                
+        if leader:
+            try:
+                call['result'] = fn()
+            except Exception as err:
+                call['error'] = err
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call['event'].set()
+        elif not call['event'].wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+            raise requests.Timeout('Forward deadline exceeded')
             
-            log.debug (f'Returned data: {r.text}')
-            http_response(server, 200, r.text)
-            log.info (f'Response returned to Edge driver (bytes len={len(bytes(r.text, "UTF-8"))})')
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+        
+    async def async_do(self, key, fn, deadline=None):
+        
+        future = self.futures.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.wait_for(asyncio.shield(future), None if deadline is None else max(deadline - time.monotonic(), 0))
             
-        else:
-            log.warn (f'HTTP error returned: {r.status_code}')
-            http_response(server, r.status_code, "")
+        future = asyncio.get_running_loop().create_future()
+        self.futures[key] = future
+        self.leaders += 1
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except Exception as err:
+            future.set_exception(err)
+            future.exception()              # mark retrieved, in case nobody else was waiting
+            raise
+        finally:
+            del self.futures[key]
             
-    else:
-        log.error ('Missing URL from forward command')
-        http_response(server, 400, "")
+    def stats(self):
+        
+        return {'upstream': self.leaders, 'coalesced': self.shared}
 
 
-def error_proc(hubaddr):
+coalescer = singleflight()
 
-    key = f'{hubaddr[0]}:{hubaddr[1]}'
+
+class bodyreader(object):
     
-    if key in hubsenderrors:
-        errcount = hubsenderrors[key]
-        errcount += 1
-        if errcount == 3:
-            del hubsenderrors[key]
-            for item in registrations:
-                if item['hubaddr'] == hubaddr:
-                    regdeletelist.append(item)
-            
-        else:
-            hubsenderrors[key] = errcount
+    # File-like view of the unread request body, so it can be streamed upstream as it arrives
+    # rather than read into memory first.  __len__ lets requests send it with a Content-Length.
+    
+    def __init__(self, rfile, length):
         
-    else:
-        hubsenderrors[key] = 1
+        self.rfile = rfile
+        self.remaining = length
         
+    def read(self, size=-1):
+        
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        if size and not data:
+            self.remaining = 0
+        return data
+        
+    def __len__(self):
+        
+        return self.remaining
 
-def passto_hub(server, regrecord):
 
-        headers = {}
+scratch = threading.local()
 
-        hubaddr = regrecord['hubaddr'][0] + ':' + str(regrecord['hubaddr'][1])
 
-        if regrecord['devaddr'][1] != None:
-            devaddr = regrecord['devaddr'][0] + ':' + str(regrecord['devaddr'][1])
-        else:
-            devaddr = regrecord['devaddr'][0]
+def discard_body(rfile, length):
 
-        url = 'http://' + hubaddr + '/' + devaddr + '/' + server.command + server.path
-        headers['Host'] = hubaddr
-        
-        if server.data_bytes != None:
-            if len(server.data_bytes) > 0:
-                headers['Content-Length'] = str(len(server.data_bytes))
-                if 'Content-Type' in server.headers:
-                    headers['Content-Type'] = server.headers['Content-Type']
-                
+    # Reads and drops a request body that will not be used, through a per-thread scratch buffer
+    # so that skipping it allocates nothing.  Returns False if the client stopped sending.
+    
+    buf = getattr(scratch, 'buf', None)
+    if buf is None:
+        buf = scratch.buf = memoryview(bytearray(STREAM_CHUNK))
+    while length > 0:
+        count = rfile.readinto(buf[:min(length, STREAM_CHUNK)])
+        if not count:
+            return False
+        length -= count
+    return True
 
-        log.info (f'Sending POST: {url} to {hubaddr}')
 
-        try:
-            r = requests.post(url, headers=headers, data=server.data_bytes)
+def body_allowed(server, length):
 
-            if r.status_code == 200:
-                log.info (f"Message forwarded to Edge ID {regrecord['edgeid']}")
-            else:
-                log.error (f"ERROR sending message to Edge hub {regrecord['hubaddr']}: {str(r.status_code)}")
-        except:
-            log.error (f"FAILED sending message to Edge hub {regrecord['hubaddr']}")
-            error_proc(regrecord['hubaddr'])
+    # Request bodies are held in memory whole, so they are limited to MAX_BODY_SIZE; a streaming
+    # forward's body is piped upstream as it arrives instead (threaded engine only)
+    
+    return length <= MAX_BODY_SIZE or body_streamed(server)
 
-def verify_addr(addrstr):
 
-    port = None
+def body_streamed(server):
 
-    if not addrstr:
-        return False
+    return FORWARD_STREAMING and server.route == 'forward' and not match_registrations(server.client_address)
 
-    if ':' in addrstr:
-        addrparts = addrstr.split(':')
-        ip = addrparts[0]
-        port = int(addrparts[1])
-        #print (f'Port={port}')
-        if (port < 1) or (port > MAXPORT):
-            log.error (f'Invalid port number: {port}')
-            return False
 
-    else:
-        ip = addrstr
+def chunk_size(line):
 
-    if ip:
-        ipparts = ip.split('.')
-        if len(ipparts) == 4:
-            try:
-                if (0 <= int(ipparts[0]) < 256) and \
-                   (0 <= int(ipparts[1]) < 256) and \
-                   (0 <= int(ipparts[2]) < 256) and \
-                   (0 <= int(ipparts[3]) < 256):
+    # The size in a chunk header line; ValueError unless it is plain hex digits (int() would also
+    # take a sign, 0x or underscores, and a negative size would read to the end of the stream)
+    
+    size = line.split(b';')[0].strip()
+    if not size or size.strip(b'0123456789abcdefABCDEF'):
+        raise ValueError('invalid chunk size')
+    return int(size, 16)
 
-                    return (ip, port)
-            except:
-                log.error (f'Invalid IP address syntax: {ipparts}')
-                NotImplemented
-                
-    log.error (f'Invalid IP address: {ip}')
-    return False
 
+def read_chunked(rfile, limit):
 
-def verify_ID(id):
+    # Request body sent with Transfer-Encoding: chunked; any trailer headers are discarded.
+    # Raises ValueError on a malformed or truncated body, and OverflowError, without reading
+    # further, once the body would exceed limit bytes.
+    
+    body = []
+    total = 0
+    while True:
+        size = chunk_size(rfile.readline(65537))
+        if size == 0:
+            break
+        total += size
+        if total > limit:
+            raise OverflowError(total)
+        chunk = rfile.read(size)
+        if len(chunk) < size:
+            raise ValueError('truncated chunk')
+        body.append(chunk)
+        rfile.readline(65537)
+    while rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+        pass
+    return b''.join(body)
 
-    idprofile = [8,4,4,4,12]
 
-    id = id.lower()
-    parts = id.split('-')
-    if len(parts) == len(idprofile):
-        for i in range(len(parts)):
-            if len(parts[i]) == idprofile[i]:
-                for x in range(idprofile[i]):
-                    if parts[i][x] not in ('0','1','2','3','4','5','6','7','8','9','a','b','c','d','e','f'):
-                        return False
-            else:
-                return False
+async def async_read_chunked(reader, limit):
+
+    body = []
+    total = 0
+    while True:
+        size = chunk_size(await asyncio.wait_for(reader.readline(), CLIENT_TIMEOUT))
+        if size == 0:
+            break
+        total += size
+        if total > limit:
+            raise OverflowError(total)
+        body.append(await asyncio.wait_for(reader.readexactly(size), CLIENT_TIMEOUT))
+        await asyncio.wait_for(reader.readline(), CLIENT_TIMEOUT)
+    while await asyncio.wait_for(reader.readline(), CLIENT_TIMEOUT) not in (b'\r\n', b'\n', b''):
+        pass
+    return b''.join(body)
+
+
+def stream_forward(server, method, url, headers, timing):
+
+    # Pipe the upstream response to the Edge driver in chunks, exactly as received: no text decoding,
+    # and the upstream Content-Type/Content-Encoding are preserved, so binary bodies pass through intact.
+    # Compression is only requested if the Edge driver itself asked for it.
+
+    if 'accept-encoding' not in (key.lower() for key in headers):
+        headers['Accept-Encoding'] = 'identity'
+
+    body = server.data_bytes if server.data_bytes is not None else server.bodystream
+        
+    def attempt(connect, read):
+        return outbound.request(method, url, data=body, headers=headers, timeout=(connect, read), stream=True)
+        
+    start = time.perf_counter()
+    try:
+        # a streamed request body can only be sent once; hedging would leave a second response to drain
+        r = fwpolicy.run(attempt, method == 'get' and server.bodystream is None, timing, hedge=False)
+        reqmetrics.forward_upstream(time.perf_counter() - start)
+    except requests.Timeout as err:
+        log.error ('Internet request timed out: %s', err)
+        http_response(server, 504, "")
+        return
+    except (requests.RequestException, OSError, ValueError) as err:
+        log.error ('Internet request failed: %s', err)
+        http_response(server, 502, "")
+        return
+    
+    with r:
+        if r.status_code != HTTP_OK:
+            log.warn ('HTTP error returned: %s', r.status_code)
+            http_response(server, r.status_code, "")
+            return
+        
+        # Without an upstream length the body is sent chunked, or delimited by closing the connection for HTTP/1.0
+        chunked = 'Content-Length' not in r.headers and server.request_version == 'HTTP/1.1'
+        if 'Content-Length' not in r.headers and not chunked:
+            server.close_connection = True
+            
+        sent = 0
+        try:
+            server.send_response(200)
+            for name in ('Content-Type', 'Content-Encoding', 'Content-Length'):
+                if name in r.headers:
+                    server.send_header(name, r.headers[name])
+            if chunked:
+                server.send_header("Transfer-Encoding", 'chunked')
+            server.end_headers()
+            
+            for chunk in r.raw.stream(STREAM_CHUNK, decode_content=False):
+                if chunked:
+                    server.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                else:
+                    server.wfile.write(chunk)
+                server.wfile.flush()                # pass each chunk on as it arrives
+                sent += len(chunk)
+            if chunked:
+                server.wfile.write(b'0\r\n\r\n')
+        except Exception as err:
+            log.error ('Streaming error after %s bytes: %s', sent, err)
+            server.close_connection = True
+            return
+        finally:
+            server.bytes_out = sent
+            
+    log.info ('Response streamed to Edge driver (bytes len=%s)', sent)
+    
+
+class ratelimiter(object):
+    
+    # Token buckets keyed by client address or upstream host: each key may send rate requests a
+    # second on average, in bursts of up to burst.  Only the maxkeys most recently seen keys are
+    # tracked; a key that drops out starts again with a full bucket.
+    
+    def __init__(self, rate, burst, maxkeys=RATE_LIMIT_KEYS):
+        
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.maxkeys = maxkeys
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()        # key -> [tokens, time of last refill, requests refused]
+        self.throttled = 0
+        
+    def take(self, key):
+        
+        # Returns (0, 0) if the request may go ahead, else (seconds until the key has a token again,
+        # requests refused for the key so far)
+        
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now, 0]
+                if len(self.buckets) > self.maxkeys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0, 0
+            bucket[2] += 1
+            self.throttled += 1
+            return (1 - bucket[0]) / self.rate, bucket[2]
+            
+    def stats(self, top=10):
+        
+        # top: how many of the most throttled keys to list
+        with self.lock:
+            noisy = sorted(((bucket[2], key) for key, bucket in self.buckets.items() if bucket[2]), reverse=True)[:top]
+            return {'throttled': self.throttled, 'keys': len(self.buckets), 'noisy': {key: count for count, key in noisy}}
+
+
+clientlimits = None                     # ratelimiters, when forward_rate_per_client / forward_rate_per_host are set
+hostlimits = None
+
+
+def forward_throttled(server):
+
+    # Checked as soon as a request's headers are in: a forward from a client, or to an upstream host,
+    # that is over its rate limit gets a 429 before its body is read or anything is sent upstream.
+    # Returns True if the request was refused.
+    
+    if server.route != 'forward' or not (clientlimits or hostlimits):
+        return False
+    if match_registrations(server.client_address):
+        return False                    # a device message for the hub, not a forward
+    
+    wait = 0
+    if clientlimits:
+        scope, key = 'client', server.client_address[0]
+        wait, count = clientlimits.take(key)
+    if not wait and hostlimits and forward_url(server):
+        scope, key = 'upstream host', server.target.hostname
+        wait, count = hostlimits.take(key)
+    if not wait:
+        return False
+    
+    if count == 1 or count % 100 == 0:
+        log.warn ('Forward rate limit exceeded by %s %s (%s requests refused)', scope, key, count)
+    server.endpoint = 'forward'
+    if 'chunked' in server.headers.get('Transfer-Encoding', '').lower() or server.headers.get('Content-Length', '0') != '0':
+        server.close_connection = True  # the body is left unread
+    server.send_response(429)
+    server.send_header('Retry-After', str(max(1, round(wait))))
+    server.send_header('Content-Length', '0')
+    server.end_headers()
+    return True
+
+
+class forwardpolicy(object):
+    
+    # Timeouts, retries and hedged requests for forwards.  Each attempt gets the connect and read
+    # timeouts (per host, if overridden in the [timeouts] config section); the forward as a whole has
+    # a deadline of one attempt's worth, or whatever the Edge driver asked for with timeout=<seconds>
+    # or an X-Edgebridge-Timeout header.  Only GETs are retried or hedged:
+    #   retries     - an attempt that could not connect, timed out or got a 502/503/504 is repeated,
+    #                 after a short backoff, up to this many times while the deadline allows
+    #   hedge_after - if an attempt has not been answered after this many seconds, a second copy is
+    #                 sent and the first answer wins
+    # run() is for the threaded engine (requests), async_run() for the asyncio engine's client.
+    
+    def __init__(self, connect, read, retries=0, hedge_after=0, hosts=None):
+        
+        self.connect = connect
+        self.read = read
+        self.retries = retries
+        self.hedge_after = hedge_after
+        self.hosts = hosts or {}            # hostname -> (connect timeout, read timeout)
+        self.lock = threading.Lock()
+        self.pool = None                    # threads for hedged requests, created on first use
+        self.counts = {'retries': 0, 'hedged': 0, 'hedge_wins': 0}
+        
+    def timing(self, server):
+        
+        # (connect timeout, read timeout, deadline) for the forward in server.target; None if the
+        # Edge driver asked for an invalid timeout
+        
+        connect, read = self.hosts.get(server.target.hostname, (self.connect, self.read))
+        requested = server.fwtimeout or server.headers.get('X-Edgebridge-Timeout')
+        budget = connect + read
+        if requested:
+            try:
+                budget = float(requested)
+                if not 0 < budget <= MAX_FORWARD_DEADLINE:
+                    raise ValueError
+            except ValueError:
+                return None
+        return connect, read, time.monotonic() + budget
+        
+    def __count(self, name):
+        
+        with self.lock:
+            self.counts[name] += 1
+            
+    def __retry(self, tries, deadline, reason):
+        
+        # Seconds to wait before trying again, or None if out of retries or time
+        delay = FORWARD_RETRY_BACKOFF * (2 ** tries)
+        if tries >= self.retries or time.monotonic() + delay >= deadline:
+            return None
+        self.__count('retries')
+        log.warn ('Retrying forward in %ss (retry %s of %s): %s', delay, tries + 1, self.retries, reason)
+        return delay
+        
+    def run(self, attempt, idempotent, timing, hedge=True):
+        
+        # attempt(connect, read) sends one request and returns its requests.Response
+        
+        connect, read, deadline = timing
+        tries = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.Timeout('Forward deadline exceeded')
+            try:
+                if idempotent and hedge and 0 < self.hedge_after < min(read, remaining):
+                    r = self.__hedged(attempt, min(connect, remaining), min(read, remaining), deadline)
+                else:
+                    r = attempt(min(connect, remaining), min(read, remaining))
+                if not idempotent or r.status_code not in FORWARD_RETRY_STATUSES:
+                    return r
+                delay = self.__retry(tries, deadline, f'HTTP {r.status_code}')
+                if delay is None:
+                    return r
+                r.close()
+            except (requests.ConnectionError, requests.Timeout) as err:
+                delay = self.__retry(tries, deadline, err) if idempotent else None
+                if delay is None:
+                    raise
+            tries += 1
+            time.sleep(delay)
+            
+    def __hedged(self, attempt, connect, read, deadline):
+        
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=SERVER_THREADS * 2, thread_name_prefix='hedge')
+        first = self.pool.submit(attempt, connect, read)
+        done, pending = concurrent.futures.wait([first], timeout=self.hedge_after)
+        if not done:
+            self.__count('hedged')
+            log.debug ('No answer after %ss; sending hedged request', self.hedge_after)
+            pending = {first, self.pool.submit(attempt, connect, read)}
+            
+        error = None
+        while done or pending:
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self.__count('hedge_wins')
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                break
+            done, pending = concurrent.futures.wait(pending, timeout=max(deadline - time.monotonic(), 0),
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                raise requests.Timeout('Forward deadline exceeded')
+        raise error
+        
+    async def async_run(self, attempt, idempotent, timing):
+        
+        # attempt(connect, read) is a coroutine returning (status, headers, body)
+        
+        connect, read, deadline = timing
+        tries = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                if idempotent and 0 < self.hedge_after < min(read, remaining):
+                    response = await self.__async_hedged(attempt, min(connect, remaining), min(read, remaining), deadline)
+                else:
+                    response = await attempt(min(connect, remaining), min(read, remaining))
+                if not idempotent or response[0] not in FORWARD_RETRY_STATUSES:
+                    return response
+                delay = self.__retry(tries, deadline, f'HTTP {response[0]}')
+                if delay is None:
+                    return response
+            except (asyncio.TimeoutError, OSError, asyncio.IncompleteReadError) as err:
+                delay = self.__retry(tries, deadline, repr(err)) if idempotent else None
+                if delay is None:
+                    raise
+            tries += 1
+            await asyncio.sleep(delay)
+            
+    async def __async_hedged(self, attempt, connect, read, deadline):
+        
+        first = asyncio.ensure_future(attempt(connect, read))
+        done, pending = await asyncio.wait([first], timeout=self.hedge_after)
+        if not done:
+            self.__count('hedged')
+            log.debug ('No answer after %ss; sending hedged request', self.hedge_after)
+            pending = {first, asyncio.ensure_future(attempt(connect, read))}
+            
+        try:
+            error = None
+            while done or pending:
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.__count('hedge_wins')
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=max(deadline - time.monotonic(), 0),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()               # the loser's connection is closed, not returned to the pool
+                
+    def stats(self):
+        
+        with self.lock:
+            return dict(self.counts)
+            
+    def close(self):
+        
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+
+fwpolicy = forwardpolicy(DEFAULT_FW_CONNECT_TIMEOUT, DEFAULT_FWTIMEOUT)
+
+
+def proc_forward (server, method):
+
+    url = forward_url(server)
+    if not url:
+        log.error ('Missing or invalid URL in forward command')
+        http_response(server, 400, "")
+        return
+        
+    log.info ('Sending %s to %s', method, url)
+    
+    headers = build_headers(server)
+            
+    log.debug ('Headers: %s', headers)
+    if server.data_bytes:
+        if log.debugging:
+            log.debug ('Body (%s bytes): %s', len(server.data_bytes), server.data_bytes[:LOG_BODY_MAX].decode("utf-8", errors="replace"))
+            
+    lc_method = method.lower()
+    if lc_method not in ['post', 'put', 'get']:
+        log.error ('Unsupported forward method: %s', method)
+        http_response(server, 405, "")
+        return
+        
+    timing = fwpolicy.timing(server)
+    if not timing:
+        log.error ('Invalid forward timeout: %s', server.fwtimeout or server.headers.get('X-Edgebridge-Timeout'))
+        http_response(server, 400, "")
+        return
+        
+    if FORWARD_STREAMING:
+        stream_forward(server, lc_method, url, headers, timing)
+        return
+        
+    cachekey = fwcache.key(method, url, headers) if fwcache and not server.data_bytes else None
+    if cachekey:
+        entry, fresh = fwcache.lookup(cachekey)
+        if fresh:
+            sent = http_response(server, 200, entry['text'])
+            log.info ('Cached response returned to Edge driver (bytes len=%s)', sent)
+            return
+        if entry:
+            headers.update(fwcache.conditional_headers(entry))
+    
+    def attempt(connect, read):
+        return outbound.request(lc_method, url, data=server.data_bytes, headers=headers, timeout=(connect, read))
+        
+    start = time.perf_counter()
+    try:
+        flightkey = singleflight.key(method, url, headers) if FORWARD_COALESCING and not server.data_bytes else None
+        if flightkey:
+            r = coalescer.do(flightkey, lambda: fwpolicy.run(attempt, True, timing), timing[2])
+        else:
+            r = fwpolicy.run(attempt, lc_method == 'get', timing)
+        reqmetrics.forward_upstream(time.perf_counter() - start)
+        if log.debugging:
+            log.debug ('Connection pool: %s', outbound.stats())
+    except requests.Timeout as err:
+        log.error ('Internet request timed out: %s', err)
+        http_response(server, 504, "")
+        return
+    except (requests.RequestException, OSError, ValueError) as err:
+        log.error ('Internet request failed: %s', err)
+        http_response(server, 502, "")
+        return
+        
+    if r.status_code == HTTP_OK:
+        
+        text = r.text
+        log.debug ('Returned data: %s', text)
+        sent = http_response(server, 200, text)
+        log.info ('Response returned to Edge driver (bytes len=%s)', sent)
+        if cachekey:
+            fwcache.store(cachekey, r.headers, text)
+            
+    elif r.status_code == 304 and cachekey and entry:
+        fwcache.refresh(cachekey, entry, r.headers)
+        sent = http_response(server, 200, entry['text'])
+        log.info ('Revalidated cached response returned to Edge driver (bytes len=%s)', sent)
+        
+    else:
+        log.warn ('HTTP error returned: %s', r.status_code)
+        http_response(server, r.status_code, "")
+
+
+class hubhealth(object):
+    
+    # Delivery health of each hub address ('ip:port'), with a circuit breaker per hub.  After
+    # 'threshold' consecutive failed sends the circuit opens, and sends to that hub fail fast without
+    # a connection attempt.  After 'cooldown' seconds it goes half-open and lets one probe send through:
+    # success closes it again, failure re-opens it.  Any successful send resets the failure count.
+    # A hub that has been failing without a single success for 'scrub_after' seconds is reported by
+    # failure() so that its (presumably orphaned) registrations can be scrubbed.
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALFOPEN = 'half-open'
+    
+    def __init__(self, threshold, cooldown, scrub_after, alpha=0.2):
+        
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.scrub_after = scrub_after
+        self.alpha = alpha                  # weight of the newest sample in the latency EWMA
+        self.lock = threading.Lock()
+        self.hubs = {}
+        
+    def __hub(self, hubaddr):
+        
+        # called with self.lock held
+        key = f'{hubaddr[0]}:{hubaddr[1]}'
+        hub = self.hubs.get(key)
+        if hub is None:
+            hub = self.hubs[key] = {'state': self.CLOSED, 'failures': 0, 'failing_since': None, 'changed': 0,
+                                    'probing': False, 'latency': None, 'sent': 0, 'failed': 0, 'rejected': 0,
+                                    'trips': 0, 'last_ok': None, 'last_failure': None}
+        return hub
+        
+    def allow(self, hubaddr):
+        
+        # Returns False if the hub's circuit is open and a send should fail fast
+        
+        with self.lock:
+            hub = self.__hub(hubaddr)
+            now = time.monotonic()
+            if hub['state'] == self.CLOSED:
+                return True
+            if now - hub['changed'] >= self.cooldown:
+                if hub['state'] == self.OPEN:
+                    log.info ('Edge hub %s:%s circuit half-open; probing', hubaddr[0], hubaddr[1])
+                hub['state'] = self.HALFOPEN
+                hub['changed'] = now                # a probe that never reports back is replaced after the cooldown
+                hub['probing'] = True
+                return True
+            hub['rejected'] += 1
+            return False
+            
+    def retry_in(self, hubaddr):
+        
+        # Seconds until an open circuit will let a probe through
+        
+        with self.lock:
+            hub = self.__hub(hubaddr)
+            if hub['state'] == self.CLOSED:
+                return 0
+            return max(self.cooldown - (time.monotonic() - hub['changed']), 0.1)
+            
+    def success(self, hubaddr, latency):
+        
+        with self.lock:
+            hub = self.__hub(hubaddr)
+            if hub['state'] != self.CLOSED:
+                log.info ('Edge hub %s:%s circuit closed', hubaddr[0], hubaddr[1])
+            hub['state'] = self.CLOSED
+            hub['probing'] = False
+            hub['failures'] = 0
+            hub['failing_since'] = None
+            hub['sent'] += 1
+            hub['last_ok'] = time.time()
+            if hub['latency'] is None:
+                hub['latency'] = latency
+            else:
+                hub['latency'] += self.alpha * (latency - hub['latency'])
+                
+    def failure(self, hubaddr):
+        
+        # Returns True once the hub has been failing for long enough that its registrations should be scrubbed
+        
+        with self.lock:
+            hub = self.__hub(hubaddr)
+            now = time.monotonic()
+            hub['failures'] += 1
+            hub['failed'] += 1
+            hub['last_failure'] = time.time()
+            if hub['failing_since'] is None:
+                hub['failing_since'] = now
+            if hub['state'] == self.HALFOPEN or (hub['state'] == self.CLOSED and hub['failures'] >= self.threshold):
+                hub['state'] = self.OPEN
+                hub['changed'] = now
+                hub['probing'] = False
+                hub['trips'] += 1
+                log.warn ('Edge hub %s:%s circuit open after %s consecutive failure(s); retrying in %ss',
+                          hubaddr[0], hubaddr[1], hub['failures'], self.cooldown)
+            if now - hub['failing_since'] >= self.scrub_after:
+                hub['failing_since'] = now          # scrub at most once per interval
+                return True
+            return False
+            
+    def stats(self):
+        
+        with self.lock:
+            stats = {}
+            for key, hub in self.hubs.items():
+                stats[key] = {'state': hub['state'], 'consecutive_failures': hub['failures'],
+                              'latency_ms': round(hub['latency'] * 1000, 1) if hub['latency'] is not None else None,
+                              'sent': hub['sent'], 'failed': hub['failed'], 'rejected': hub['rejected'], 'trips': hub['trips'],
+                              'last_ok': email.utils.formatdate(hub['last_ok'], usegmt=True) if hub['last_ok'] else None,
+                              'last_failure': email.utils.formatdate(hub['last_failure'], usegmt=True) if hub['last_failure'] else None}
+            return stats
+
+
+hubstatus = hubhealth(DEFAULT_HUB_FAILURES, DEFAULT_HUB_OPEN_SECS, DEFAULT_HUB_SCRUB_SECS)
+
+
+def error_proc(hubaddr):
+
+    # Count a failed send against the hub; once it has been failing long enough, queue its registrations for scrubbing
+    
+    if hubstatus.failure(hubaddr):
+        with reglock:
+            for item in registrations.for_hub(hubaddr):
+                if item not in regdeletelist:
+                    regdeletelist.append(item)
+        
+
+def hub_request(server, regrecord):
+
+        hubaddr = regrecord.hubhost
+        url = regrecord.huburl + server.command + server.path
+        headers = {'Host': hubaddr}
+        
+        if server.data_bytes != None:
+            if len(server.data_bytes) > 0:
+                headers['Content-Length'] = str(len(server.data_bytes))
+                if 'Content-Type' in server.headers:
+                    headers['Content-Type'] = server.headers['Content-Type']
+                
+        return url, headers, hubaddr
+
+
+def record_hub_response(hubaddr, status, latency):
+
+    # A hub that answers is alive, unless it answers with a server error
+    
+    if status < 500:
+        hubstatus.success(hubaddr, latency)
+    else:
+        error_proc(hubaddr)
+
+
+def passto_hub(server, regrecord):
+
+        # Returns the delivery outcome and latency in seconds, for the fan-out report
+
+        url, headers, hubaddr = hub_request(server, regrecord)
+
+        if not hubstatus.allow(regrecord.hubaddr):
+            log.warn ('Edge hub %s is not responding; message not sent', hubaddr)
+            return 'circuit open', 0
+
+        log.info ('Sending POST: %s to %s', url, hubaddr)
+
+        start = time.monotonic()
+        try:
+            r = outbound.request('post', url, headers=headers, data=server.data_bytes, timeout=HUB_TIMEOUT)
+
+            if r.status_code == 200:
+                log.info ("Message forwarded to Edge ID %s", regrecord.edgeid)
+                outcome = 'ok'
+            else:
+                log.error ("ERROR sending message to Edge hub %s: %s", regrecord.hubaddr, r.status_code)
+                outcome = f'HTTP {r.status_code}'
+            record_hub_response(regrecord.hubaddr, r.status_code, time.monotonic() - start)
+        except requests.Timeout:
+            log.error ("TIMED OUT sending message to Edge hub %s", regrecord.hubaddr)
+            error_proc(regrecord.hubaddr)
+            outcome = 'timeout'
+        except:
+            log.error ("FAILED sending message to Edge hub %s", regrecord.hubaddr)
+            error_proc(regrecord.hubaddr)
+            outcome = 'failed'
+            
+        latency = time.monotonic() - start
+        reqmetrics.hub_delivery(latency)
+        return outcome, latency
+
+
+def report_delivery(results):
+
+    # results: list of (regrecord, outcome, latency) - one per hub the message was sent to
+    
+    summary = ', '.join(f"{record.hubhost} {outcome} {latency * 1000:.0f}ms"
+                        for record, outcome, latency in results)
+    log.info ('Delivery to %s hub(s): %s', len(results), summary)
+
+
+def deliver_to_hubs(server, matches):
+
+    # Send to all matching registrations concurrently; waits no longer than the hub timeout.  Sends
+    # still running after that get a copy of the message, since the connection's next request
+    # reuses the request handler.
+
+    server = hubmessage.of(server)
+    if len(matches) == 1:
+        outcome, latency = passto_hub(server, matches[0])
+        results = [(matches[0], outcome, latency)]
+        
+    else:
+        futures = {hubpool.submit(passto_hub, server, record): record for record in matches}
+        done, notdone = concurrent.futures.wait(futures, timeout=HUB_TIMEOUT + 1)
+        results = []
+        for future, record in futures.items():
+            if future in done:
+                outcome, latency = future.result()
+                results.append((record, outcome, latency))
+            else:
+                results.append((record, 'deadline exceeded', HUB_TIMEOUT + 1))
+                
+    report_delivery(results)
+    scrub_registrations()
+
+
+def send_to_hubs(server, matches):
+
+    # Background delivery (hub_ack_immediate, message batches): each registration is sent by its own
+    # hubpool task and the last one to finish reports and scrubs, so no hubpool worker is held
+    # waiting for others that may be queued behind it.  The tasks get a copy of the message, since
+    # the connection's next request reuses the request handler.
+
+    server = hubmessage.of(server)
+    results = []
+    lock = threading.Lock()
+    
+    def delivered(future, record):
+        try:
+            outcome, latency = future.result()
+        except Exception as err:
+            outcome, latency = f'failed ({err})', 0
+        with lock:
+            results.append((record, outcome, latency))
+            finished = len(results) == len(matches)
+        if finished:
+            report_delivery(results)
+            scrub_registrations()
+            
+    for record in matches:
+        future = hubpool.submit(passto_hub, server, record)
+        future.add_done_callback(lambda future, record=record: delivered(future, record))
+
+
+class deliveryqueue(object):
+    
+    # Queued hub delivery: request threads only enqueue, and a worker thread per hub address sends
+    # that hub's messages in order.  Failed sends (connection errors, timeouts, 5xx) are retried up to
+    # 'retries' times with exponential backoff before the message is dropped; every failed attempt is
+    # counted against the hub's health.  While the hub's circuit is open, its queue waits for the
+    # circuit to let a probe through rather than spending retries.  Each hub queue holds at most 'maxdepth' messages; beyond that new
+    # messages are rejected.  With a spool file, queued messages are journaled so they survive a restart.
+    
+    def __init__(self, maxdepth, retries, backoff, spoolfile=None):
+        
+        self.maxdepth = maxdepth
+        self.retries = retries
+        self.backoff = backoff
+        self.spoolfile = spoolfile
+        self.hubs = {}                      # 'ip:port' -> deque of pending jobs
+        self.workers = {}                   # 'ip:port' -> worker thread
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.nextid = 0
+        self.counts = {'enqueued': 0, 'delivered': 0, 'retries': 0, 'dropped': 0, 'rejected': 0}
+        self.spool = None
+        self.spoollines = 0                 # lines in the spool file
+        if spoolfile:
+            self.__loadspool()
+            
+    def __loadspool(self):
+        
+        pending = OrderedDict()
+        try:
+            with open(self.spoolfile, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue                # partial last line from a crash
+                    if entry['op'] == 'add':
+                        job = entry['job']
+                        job['body'] = base64.b64decode(job['body']) if job['body'] is not None else None
+                        pending[job['id']] = job
+                    else:
+                        pending.pop(entry['id'], None)
+        except FileNotFoundError:
+            pass
+            
+        self.spool = open(self.spoolfile, 'w')
+        self.spoollines = 0
+        with self.cond:
+            for job in pending.values():
+                self.nextid = max(self.nextid, job['id'] + 1)
+                self.__queue(job)
+        if pending:
+            log.info ('Restored %s queued hub message(s) from %s', len(pending), self.spoolfile)
+            
+    @staticmethod
+    def __spoolline(entry):
+        
+        if entry['op'] == 'add':
+            job = dict(entry['job'])
+            job['body'] = base64.b64encode(job['body']).decode('ascii') if job['body'] is not None else None
+            entry = {'op': 'add', 'job': job}
+        return json.dumps(entry) + '\n'
+        
+    def __journal(self, entry):
+        
+        # called with self.cond held.  The spool is compacted when nothing is pending, or when it has
+        # grown to several lines per pending message (one hub down keeps its queue from emptying
+        # while messages for the others come and go), by rewriting just the pending messages.
+        if self.spool:
+            self.spool.write(self.__spoolline(entry))
+            self.spool.flush()
+            self.spoollines += 1
+            if entry['op'] == 'done':
+                pending = sum(len(jobs) for jobs in self.hubs.values())
+                if not pending:
+                    self.spool.seek(0)
+                    self.spool.truncate()
+                    self.spoollines = 0
+                elif self.spoollines >= 4 * pending + SPOOL_COMPACT_MIN:
+                    self.__compact(pending)
+                    
+    def __compact(self, pending):
+        
+        # called with self.cond held; atomically replaces the spool, as write_regs does the registrations
+        try:
+            with open(self.spoolfile + '.tmp', 'w') as f:
+                for jobs in self.hubs.values():
+                    for job in jobs:
+                        f.write(self.__spoolline({'op': 'add', 'job': job}))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.spoolfile + '.tmp', self.spoolfile)
+        except OSError as err:
+            log.error ('Error compacting hub spool %s: %s', self.spoolfile, err)
+            return
+        self.spool.close()
+        self.spool = open(self.spoolfile, 'a')
+        self.spoollines = pending
+                
+    def __queue(self, job):
+        
+        # called with self.cond held
+        hub = job['hub']
+        self.hubs.setdefault(hub, deque()).append(job)
+        self.__journal({'op': 'add', 'job': job})
+        if hub not in self.workers:
+            worker = threading.Thread(target=self.__worker, args=(hub,), name=f'hubqueue-{hub}', daemon=True)
+            self.workers[hub] = worker
+            worker.start()
+        self.cond.notify_all()
+        
+    def enqueue(self, server, regrecord):
+        
+        url, headers, hub = hub_request(server, regrecord)
+        
+        with self.cond:
+            if self.stopping or len(self.hubs.get(hub, ())) >= self.maxdepth:
+                self.counts['rejected'] += 1
+                log.warn ('Delivery queue for Edge hub %s is full; message rejected', hub)
+                return False
+            job = {'id': self.nextid, 'hub': hub, 'url': url, 'headers': headers, 'body': server.data_bytes,
+                   'hubaddr': list(regrecord.hubaddr), 'edgeid': regrecord.edgeid, 'attempts': 0}
+            self.nextid += 1
+            self.counts['enqueued'] += 1
+            self.__queue(job)
+            log.info ('Message queued for Edge hub %s (queue depth %s)', hub, len(self.hubs[hub]))
+            return True
+            
+    def __send(self, job):
+        
+        # Returns True when done with the job (delivered, or not worth retrying)
+        
+        start = time.monotonic()
+        try:
+            r = outbound.request('post', job['url'], headers=job['headers'], data=job['body'], timeout=HUB_TIMEOUT)
+            record_hub_response(job['hubaddr'], r.status_code, time.monotonic() - start)
+            reqmetrics.hub_delivery(time.monotonic() - start)
+            if r.status_code == 200:
+                log.info ('Message forwarded to Edge ID %s', job['edgeid'])
+                with self.cond:
+                    self.counts['delivered'] += 1
+                return True
+            log.error ('ERROR sending message to Edge hub %s: %s', job['hub'], r.status_code)
+            return r.status_code < 500
+        except Exception as err:
+            log.error ('FAILED sending message to Edge hub %s: %s', job['hub'], err)
+            error_proc(job['hubaddr'])
+            reqmetrics.hub_delivery(time.monotonic() - start)
+            return False
+            
+    def __worker(self, hub):
+        
+        pending = self.hubs[hub]
+        while True:
+            with self.cond:
+                while not pending and not self.stopping:
+                    if not self.cond.wait(timeout=DEFAULT_POOL_IDLE) and not pending:
+                        del self.workers[hub]   # idle hub: let its worker go
+                        del self.hubs[hub]
+                        return
+                if self.stopping:
+                    return
+                job = pending[0]
+                
+                if not hubstatus.allow(job['hubaddr']):
+                    self.cond.wait_for(lambda: self.stopping, timeout=hubstatus.retry_in(job['hubaddr']))
+                    continue
+                
+            done = self.__send(job)
+            
+            with self.cond:
+                if not done:
+                    job['attempts'] += 1
+                    if job['attempts'] <= self.retries:
+                        self.counts['retries'] += 1
+                        delay = self.backoff * (2 ** (job['attempts'] - 1))
+                        log.warn ('Retrying message to Edge hub %s in %ss (attempt %s of %s)', hub, delay, job['attempts'], self.retries)
+                        self.cond.wait_for(lambda: self.stopping, timeout=delay)
+                        continue
+                    self.counts['dropped'] += 1
+                    log.error ('Giving up on message to Edge hub %s after %s attempt(s)', hub, job['attempts'])
+                pending.popleft()
+                self.__journal({'op': 'done', 'id': job['id']})
+                
+            if not done:
+                scrub_registrations()
+                
+    def stats(self):
+        
+        with self.cond:
+            stats = dict(self.counts)
+            stats['depth'] = {hub: len(jobs) for hub, jobs in self.hubs.items() if jobs}
+            return stats
+            
+    def close(self):
+        
+        # Stop the workers; anything still queued stays in the spool for the next start
+        
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for worker in list(self.workers.values()):
+            worker.join(HUB_TIMEOUT + 1)
+        with self.cond:
+            if self.spool:
+                self.spool.close()
+                self.spool = None
+
+
+hubqueue = None                         # deliveryqueue, when hub_delivery_queue is enabled
+
+
+class hubmessage(object):
+    
+    # The parts of a device request that hub_request uses, kept after the request itself is done
+    
+    def __init__(self, command, path, headers, data_bytes):
+        
+        self.command = command
+        self.path = path
+        self.headers = headers
+        self.data_bytes = data_bytes
+        
+    @classmethod
+    def of(cls, server):
+        
+        headers = {'Content-Type': server.headers['Content-Type']} if 'Content-Type' in server.headers else {}
+        return cls(server.command, server.path, headers, server.data_bytes)
+
+
+class hubbatcher(object):
+    
+    # Debouncing for registrations made with batch=latest or batch=array.  Messages for the same
+    # registration, method and path (ignoring any query string) that arrive within the registration's
+    # window go to the hub as one POST: the latest message alone, or all of them as a JSON array of
+    # {"path", "body"} objects (at most maxmessages; a full batch is sent at once).  The window starts
+    # with the first message and is not extended by later ones, so a device that never goes quiet
+    # still gets a message through every window.  Batches are sent by a single timer thread, through
+    # the hub delivery queue if there is one, else on the hub delivery worker pool.
+    
+    def __init__(self, maxmessages=BATCH_MAX_MESSAGES):
+        
+        self.maxmessages = maxmessages
+        self.cond = threading.Condition()
+        self.pending = {}                   # (registration key, method, path) -> [regrecord, mode, messages, seq]
+        self.due = []                       # heap of (send time, seq, pending key)
+        self.seq = 0
+        self.counts = {'received': 0, 'sent': 0, 'suppressed': 0, 'batched': 0}
+        self.devices = {}                   # device address -> {'suppressed': n, 'batched': n}
+        self.worker = None
+        
+    def __schedule(self, key, batch, delay):
+        
+        # called with self.cond held
+        self.seq += 1
+        batch[3] = self.seq
+        heapq.heappush(self.due, (time.monotonic() + delay, self.seq, key))
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.__worker, name='hubbatcher', daemon=True)
+            self.worker.start()
+        self.cond.notify()
+        
+    def add(self, server, regrecord):
+        
+        mode, window = regrecord.batch
+        message = hubmessage.of(server)
+        key = (regrecord.key, server.command, server.path.partition('?')[0])
+        
+        with self.cond:
+            self.counts['received'] += 1
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = self.pending[key] = [regrecord, mode, [message], 0]
+                self.__schedule(key, batch, window / 1000)
+                return
+            
+            outcome = 'suppressed' if mode == 'latest' else 'batched'
+            self.counts[outcome] += 1
+            devcounts = self.devices.setdefault(regrecord.device(), {'suppressed': 0, 'batched': 0})
+            devcounts[outcome] += 1
+            if mode == 'latest':
+                batch[2][0] = message
+            else:
+                batch[2].append(message)
+                if len(batch[2]) >= self.maxmessages:
+                    self.__schedule(key, batch, 0)
+                    
+    def __worker(self):
+        
+        while True:
+            with self.cond:
+                while not self.due or self.due[0][0] > time.monotonic():
+                    self.cond.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                _, seq, key = heapq.heappop(self.due)
+                batch = self.pending.get(key)
+                if batch is None or batch[3] != seq:
+                    continue                # already sent early, when it filled up
+                del self.pending[key]
+                self.counts['sent'] += 1
+            self.__send(batch)
+            
+    def __send(self, batch):
+        
+        regrecord, mode, messages, _ = batch
+        message = messages[-1]
+        if mode == 'array':
+            items = []
+            for item in messages:
+                try:
+                    body = json.loads(item.data_bytes) if item.data_bytes else None
+                except ValueError:
+                    body = item.data_bytes.decode('utf-8', errors='replace')
+                items.append({'path': item.path, 'body': body})
+            message = hubmessage(message.command, message.path, {'Content-Type': 'application/json'}, json.dumps(items).encode('utf-8'))
+            
+        log.info ('Sending batch of %s message(s) from %s to Edge ID %s', len(messages), regrecord.device(), regrecord.edgeid)
+        if hubqueue:
+            hubqueue.enqueue(message, regrecord)
+        else:
+            send_to_hubs(message, [regrecord])
+            
+    def flush(self):
+        
+        # Send everything still waiting for its window to close (at shutdown)
+        
+        with self.cond:
+            batches = list(self.pending.values())
+            self.pending.clear()
+            self.counts['sent'] += len(batches)
+        for batch in batches:
+            self.__send(batch)
+            
+    def stats(self):
+        
+        with self.cond:
+            stats = dict(self.counts)
+            stats['pending'] = len(self.pending)
+            stats['devices'] = {device: dict(counts) for device, counts in self.devices.items()}
+            return stats
+
+
+hubbatches = hubbatcher()
+
+
+def verify_addr(addrstr):
+
+    port = None
+
+    if not addrstr:
+        return False
+
+    if ':' in addrstr:
+        ip, _, port = addrstr.partition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            log.error (f'Invalid port number: {port}')
+            return False
+        #print (f'Port={port}')
+        if (port < 1) or (port > MAXPORT):
+            log.error (f'Invalid port number: {port}')
+            return False
+
+    else:
+        ip = addrstr
+
+    if ip:
+        ipparts = ip.split('.')
+        if len(ipparts) == 4:
+            try:
+                if (0 <= int(ipparts[0]) < 256) and \
+                   (0 <= int(ipparts[1]) < 256) and \
+                   (0 <= int(ipparts[2]) < 256) and \
+                   (0 <= int(ipparts[3]) < 256):
+
+                    return (ip, port)
+            except:
+                log.error (f'Invalid IP address syntax: {ipparts}')
+                NotImplemented
+                
+    log.error (f'Invalid IP address: {ip}')
+    return False
+
+
+def verify_ID(id):
+
+    idprofile = [8,4,4,4,12]
+
+    id = id.lower()
+    parts = id.split('-')
+    if len(parts) == len(idprofile):
+        for i in range(len(parts)):
+            if len(parts[i]) == idprofile[i]:
+                for x in range(idprofile[i]):
+                    if parts[i][x] not in ('0','1','2','3','4','5','6','7','8','9','a','b','c','d','e','f'):
+                        return False
+            else:
+                return False
+    else:
+        return False
+
+    return id
+
+
+class registration(object):
+    
+    # One registration, built once when it is loaded from file or registered and never changed after
+    # (except that the regstore swaps in the hubaddr tuple shared by that hub's registrations).  Its
+    # devaddr/edgeid key is the tuple the regstore indexes it by, and the start of the hub URL and its
+    # Host header are precomputed for every message passed on.
+    
+    __slots__ = ('key', 'hubaddr', 'batch', 'hubhost', 'huburl')
+    
+    def __init__(self, devaddr, edgeid, hubaddr, batch=None):
+        
+        devaddr = (sys.intern(devaddr[0]), devaddr[1])
+        hubaddr = (sys.intern(hubaddr[0]), hubaddr[1])
+        self.key = (devaddr, edgeid)
+        self.hubaddr = hubaddr
+        self.batch = (batch[0], int(batch[1])) if batch else None
+        self.hubhost = sys.intern(f'{hubaddr[0]}:{hubaddr[1]}')
+        device = f'{devaddr[0]}:{devaddr[1]}' if devaddr[1] != None else devaddr[0]
+        self.huburl = f'http://{self.hubhost}/{device}/'
+        
+    @classmethod
+    def load(cls, data):
+        
+        # From a record read from file; raises KeyError, TypeError, IndexError or ValueError if it is invalid
+        
+        return cls(data['devaddr'], data['edgeid'], data['hubaddr'], data.get('batch'))
+        
+    @property
+    def devaddr(self):
+        
+        return self.key[0]
+        
+    @property
+    def edgeid(self):
+        
+        return self.key[1]
+        
+    def device(self):
+        
+        devaddr = self.key[0]
+        return f'{devaddr[0]}:{devaddr[1]}' if devaddr[1] else devaddr[0]
+        
+    def rehomed(self, hubaddr):
+        
+        return registration(self.key[0], self.key[1], hubaddr, self.batch)
+        
+    def dump(self):
+        
+        # The record as saved to file
+        
+        data = {'devaddr': self.key[0], 'edgeid': self.key[1], 'hubaddr': self.hubaddr}
+        if self.batch:
+            data['batch'] = self.batch
+        return data
+        
+    def __repr__(self):
+        
+        return repr(self.dump())
+
+
+class regstore(object):
+    
+    # In-memory registration list, indexed so that the per-request lookups are O(1):
+    #   records - (devaddr, edgeid) -> registration, in registration order (the order persisted to file)
+    #   byip    - device IP -> tuple of registrations without a device port
+    #   byaddr  - (device IP, port) -> tuple of registrations with a device port
+    #   byhub   - (hub IP, port) -> {(devaddr, edgeid): registration} delivered to that hub
+    # A device has few registrations, so its buckets are tuples, rebuilt on change; a hub can have
+    # thousands, so its buckets are dicts.  hubaddrs holds the one hubaddr tuple shared by all of a
+    # hub's registrations, and is pruned with byhub when the hub's last registration goes.
+    
+    def __init__(self, reglist=()):
+        
+        self.records = {}
+        self.byip = {}
+        self.byaddr = {}
+        self.byhub = {}
+        self.hubaddrs = {}
+        for record in reglist:
+            self.add(record)
+            
+    @staticmethod
+    def key(devaddr, edgeid):
+        
+        return (tuple(devaddr), edgeid)
+        
+    def __devindex(self, devaddr):
+        
+        if devaddr[1]:
+            return self.byaddr, (devaddr[0], devaddr[1])
+        else:
+            return self.byip, devaddr[0]
+        
+    def add(self, record):
+        
+        # Adds or replaces the registration for its devaddr/edgeid; returns True if it replaced one
+        
+        key = record.key
+        replaced = key in self.records
+        if replaced:
+            self.__unindex(self.records[key])
+        record.hubaddr = self.hubaddrs.setdefault(record.hubaddr, record.hubaddr)
+        self.records[key] = record
+        
+        index, ikey = self.__devindex(key[0])
+        index[ikey] = index.get(ikey, ()) + (record,)
+        self.byhub.setdefault(record.hubaddr, {})[key] = record
+        return replaced
+        
+    def __unindex(self, record):
+        
+        index, ikey = self.__devindex(record.devaddr)
+        bucket = tuple(other for other in index.get(ikey, ()) if other is not record)
+        if bucket:
+            index[ikey] = bucket
+        else:
+            index.pop(ikey, None)
+            
+        bucket = self.byhub.get(record.hubaddr)
+        if bucket is not None:
+            bucket.pop(record.key, None)
+            if not bucket:
+                del self.byhub[record.hubaddr]
+                del self.hubaddrs[record.hubaddr]
+                    
+    def remove(self, devaddr, edgeid):
+        
+        key = self.key(devaddr, edgeid)
+        record = self.records.pop(key, None)
+        if record is not None:
+            self.__unindex(record)
+        return record
+        
+    def find(self, devaddr, edgeid):
+        
+        return self.records.get(self.key(devaddr, edgeid))
+        
+    def rehome(self, oldhub, newhub):
+        
+        # Moves the records delivered to oldhub - or, if it has no port, to any port at its IP - over to
+        # newhub, keeping each record's port if newhub has none; returns the moved records
+        
+        moved = []
+        for hubaddr in [hub for hub in self.byhub if hub == oldhub or (not oldhub[1] and hub[0] == oldhub[0])]:
+            for record in list(self.byhub[hubaddr].values()):
+                record = record.rehomed((newhub[0], newhub[1] or hubaddr[1]))
+                self.add(record)
+                moved.append(record)
+        return moved
+        
+    def footprint(self):
+        
+        # Approximate bytes held by the registrations and their indexes; objects shared between
+        # records (hub addresses, interned IPs) are counted once
+        
+        seen = set()
+        total = 0
+        pending = [self.records, self.byip, self.byaddr, self.byhub, self.hubaddrs]
+        while pending:
+            obj = pending.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            total += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                pending.extend(obj.keys())
+                pending.extend(obj.values())
+            elif isinstance(obj, tuple):
+                pending.extend(obj)
+            elif isinstance(obj, registration):
+                pending.extend(getattr(obj, name) for name in registration.__slots__)
+        return total
+        
+    def match(self, client_address):
+        
+        # Records for a message from this device: those for its IP with any port, plus its exact ip:port
+        
+        return list(self.byip.get(client_address[0], ()) + self.byaddr.get((client_address[0], client_address[1]), ()))
+        
+    def for_hub(self, hubaddr):
+        
+        return list(self.byhub.get(tuple(hubaddr), {}).values())
+        
+    def __iter__(self):
+        
+        return iter(list(self.records.values()))
+        
+    def __len__(self):
+        
+        return len(self.records)
+        
+    def __repr__(self):
+        
+        return repr(list(self.records.values()))
+
+
+registrations = regstore()
+
+
+def read_regs(regs_filename):
+
+    # Loads the registration snapshot, then replays the journal of changes made since it was written.
+    # The snapshot is read a batch of lines at a time, each batch parsed with a single json.loads;
+    # only a batch holding an unreadable line is parsed line by line.
+    
+    file_path = os.getcwd() + os.path.sep + regs_filename
+    store = regstore()
+    
+    try:
+        with open(file_path,"r") as f1:
+            while True:
+                lines = f1.readlines(REGS_LOAD_BATCH)
+                if not lines:
+                    break
+                try:
+                    records = json.loads('[' + ','.join(lines) + ']')
+                except ValueError:
+                    records = []
+                    for line in lines:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            log.warn ('Skipping unreadable registration: %s', line.strip())
+                for record in records:
+                    try:
+                        store.add(registration.load(record))
+                    except (KeyError, TypeError, IndexError, ValueError):
+                        log.warn ('Skipping unreadable registration: %s', record)
+    except OSError:
+        log.warn ('INFO: No existing registrations')
+        
+    try:
+        with open(file_path + JOURNALSUFFIX, "r") as f1:
+            for line in f1:
+                try:
+                    entry = json.loads(line)
+                    if entry['op'] == 'add':
+                        store.add(registration.load(entry['reg']))
+                    else:
+                        store.remove(entry['devaddr'], entry['edgeid'])
+                except (ValueError, KeyError, TypeError, IndexError):
+                    pass                    # partial last line from a crash
+    except OSError:
+        pass
+        
+    return store
+    
+
+def write_regs(regs_filename, reglist):
+
+    # Atomically replaces the registration snapshot: a crash leaves either the old or new file intact
+
+    file_path = os.getcwd() + os.path.sep + regs_filename
+
+    try:
+        with open(file_path + '.tmp', 'w') as f1:
+            for reg in reglist:
+                f1.write(json.dumps(reg.dump())+'\n')
+            f1.flush()
+            os.fsync(f1.fileno())
+        os.replace(file_path + '.tmp', file_path)
+        return True
+    except OSError:
+        log.error ('Error saving registrations')
+        return False
+
+
+class regjournal(object):
+    
+    # Registration changes are appended to a journal by a background writer, one fsync per batch, so the
+    # request path never rewrites the whole registration file.  After 'compact_every' journal entries
+    # (and at shutdown) the full list is written as a new snapshot by write_regs and the journal emptied.
+    
+    def __init__(self, regs_filename, compact_every=1000):
+        
+        self.regs_filename = regs_filename
+        self.file_path = os.getcwd() + os.path.sep + regs_filename + JOURNALSUFFIX
+        self.compact_every = compact_every
+        self.entries = 0
+        self.queue = queue.Queue()
+        self.journal = open(self.file_path, 'a')
+        self.writer = threading.Thread(target=self.__writer, name='regjournal', daemon=True)
+        self.writer.start()
+        
+    def record(self, changes):
+        
+        # Queues a list of ('add' | 'del', record) changes, which are journaled in the same write
+        
+        self.queue.put([{'op': 'add', 'reg': record.dump()} if op == 'add' else
+                        {'op': 'del', 'devaddr': record.devaddr, 'edgeid': record.edgeid}
+                        for op, record in changes])
+        
+    def compact(self):
+        
+        # Entries still queued are already reflected in the snapshot; replaying them again is harmless
+        
+        with reglock:
+            snapshot = list(registrations)
+        if write_regs(self.regs_filename, snapshot):
+            self.journal.seek(0)
+            self.journal.truncate()
+            self.entries = 0
+            return True
+        return False
+            
+    def __writer(self):
+        
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+                
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            entries = [entry for changes in batch for entry in changes]
+            
+            # A new snapshot holds these changes already, so when one is due they are not journaled too
+            compacting = (stop and (entries or self.journal.tell())) or self.entries + len(entries) >= self.compact_every
+            try:
+                if not (compacting and self.compact()) and entries:
+                    self.journal.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+                    self.journal.flush()
+                    os.fsync(self.journal.fileno())
+                    self.entries += len(entries)
+            except OSError as err:
+                log.error ('Error saving registrations: %s', err)
+                
+            if stop:
+                self.journal.close()
+                return
+                
+    def close(self):
+        
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+
+
+regsjournal = None                      # regjournal; created by the mainline once registrations are loaded
+
+
+def persist_reg(op, record):
+
+    persist_regs([(op, record)])
+    
+    
+def persist_regs(changes):
+
+    # Persists several registration changes with a single journal write
+
+    if regsjournal and changes:
+        regsjournal.record(changes)
+
+
+def verify_batch(batch, window):
+
+    # Optional debouncing of a device's messages: batch=latest|array, window=<milliseconds>.
+    # Returns (mode, window), None for no batching, or False if the setting is invalid.
+
+    if batch in BATCH_MODES:
+        try:
+            window = int(window) if window is not None else DEFAULT_BATCH_WINDOW
+            if not 0 < window <= MAX_BATCH_WINDOW:
+                raise ValueError
+        except (ValueError, TypeError):
+            log.error ('Invalid batch window: %s', window)
+            return False
+        return (batch, window)
+    elif batch not in (None, '', 'none') or window is not None:
+        log.error ('Invalid batch setting: %s', batch)
+        return False
+    else:
+        return None
+
+
+def proc_register(server, method):
+   
+    devaddr = hubaddr = edgeid = batch = window = None
+    
+    for name, value in urllib.parse.parse_qsl(server.query, keep_blank_values=True):
+        if name == 'devaddr':
+            devaddr = verify_addr(value)
+        elif name == 'hubaddr':
+            hubaddr = verify_addr(value)
+        elif name == 'edgeid':
+            edgeid = verify_ID(value)
+        elif name == 'batch':
+            batch = value.lower()
+        elif name == 'window':
+            window = value
+        else:
+            log.error ('Unrecognized argument in register command')
+            http_response(server, 400, "")
+            return
+            
+    batch = verify_batch(batch, window)
+    if batch is False:
+        http_response(server, 400, "")
+        return
+
+    with reglock:
+        if devaddr and hubaddr and edgeid:
+
+            if method in ['post', 'Post', 'POST']:
+                log.info ('Request to register device at %s', devaddr)
+            
+                record = registration(devaddr, edgeid, hubaddr, batch)
+                if batch:
+                    log.info ('Messages will be batched (%s) over %sms', batch[0], batch[1])
+                replaced = registrations.add(record)
+                persist_reg('add', record)
+                if not replaced:
+                    log.info ('Registration record ADDED')
+               
+                else:
+                    log.info ('Existing registration was REPLACED')
+
+                http_response(server, 200, "")
+            
+            elif method in ['delete', 'Delete', 'DELETE']:
+                log.info ('Request to remove registration %s', devaddr)
+
+                record = registrations.remove(devaddr, edgeid)
+                if record != None:
+                    persist_reg('del', record)
+                    log.info ('Registration %s DELETED', devaddr)
+                    http_response(server, 200, "")
+                else:
+                    log.warn ('Request to remove address that is not registered: %s', devaddr)
+                    http_response(server, 404, "")
+            else:
+                log.error ('Invalid method provided (%s) for register command', method)
+                http_response(server, 405, "")
+        else:
+            log.error ('Missing argument(s) in register command')
+            http_response(server, 400, "")
+    
+        log.info ('Registrations: %s', len(registrations))
+        if log.debugging:
+            log.debug ('Updated registrations: %s', registrations)
+
+
+def bulk_change(item):
+
+    # Validates one entry of a bulk registration request, returning (op, devaddr, edgeid, registration
+    # or None for a delete); raises ValueError naming the first problem found
+
+    if not isinstance(item, dict):
+        raise ValueError('not a JSON object')
+    op = str(item.get('op', 'add')).lower()
+    if op not in BULK_OPS:
+        raise ValueError(f'unknown op: {op}')
+    unknown = set(item) - BULK_FIELDS
+    if unknown:
+        raise ValueError(f'unrecognized field(s): {", ".join(sorted(unknown))}')
+        
+    def text(name):
+        value = item.get(name)
+        return value if isinstance(value, str) else ''
+        
+    devaddr = verify_addr(text('devaddr'))
+    if not devaddr:
+        raise ValueError('invalid devaddr')
+    edgeid = verify_ID(text('edgeid'))
+    if not edgeid:
+        raise ValueError('invalid edgeid')
+    if op == 'delete':
+        return op, devaddr, edgeid, None
+        
+    hubaddr = verify_addr(text('hubaddr'))
+    if not hubaddr or not hubaddr[1]:
+        raise ValueError('invalid hubaddr (IP:port)')
+    batch = item.get('batch')
+    batch = verify_batch(batch.lower() if isinstance(batch, str) else batch, item.get('window'))
+    if batch is False:
+        raise ValueError('invalid batch or window')
+    return op, devaddr, edgeid, registration(devaddr, edgeid, hubaddr, batch)
+
+
+def proc_bulk_register(server):
+
+    # POST /api/register/bulk with a JSON array of registrations to add (or replace), replace (only if
+    # registered) or delete.  The request is a single transaction: if any entry is invalid, or is a
+    # replace of an address that is not registered, nothing is changed and the response lists the
+    # failing entries; otherwise every change is applied under one lock and persisted in one write.
+
+    if server.command != 'POST':
+        log.error ('Invalid method provided (%s) for bulk register command', server.command)
+        http_response(server, 405, "")
+        return
+        
+    try:
+        items = json.loads(server.data_bytes or b'')
+        if not isinstance(items, list):
+            raise ValueError
+    except ValueError:
+        log.error ('Bulk register command body is not a JSON array')
+        http_response(server, 400, "")
+        return
+        
+    changes = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            changes.append(bulk_change(item))
+        except ValueError as err:
+            errors.append({'index': index, 'error': str(err)})
+    if errors:
+        log.error ('Bulk register command refused: %s invalid entries', len(errors))
+        http_response(server, 400, json.dumps({'errors': errors}), 'application/json')
+        return
+        
+    with reglock:
+        present = {}                        # key -> registered, as of the entries before this one
+        for index, (op, devaddr, edgeid, record) in enumerate(changes):
+            key = regstore.key(devaddr, edgeid)
+            registered = present[key] if key in present else registrations.find(devaddr, edgeid) is not None
+            if op == 'replace' and not registered:
+                errors.append({'index': index, 'error': 'not registered'})
+            present[key] = op != 'delete'
+        if errors:
+            log.warn ('Bulk register command refused: %s replaced addresses are not registered', len(errors))
+            http_response(server, 409, json.dumps({'errors': errors}), 'application/json')
+            return
+            
+        counts = dict.fromkeys(('added', 'replaced', 'deleted', 'not_found'), 0)
+        persisted = []
+        for op, devaddr, edgeid, record in changes:
+            if op == 'delete':
+                removed = registrations.remove(devaddr, edgeid)
+                if removed is None:
+                    counts['not_found'] += 1
+                else:
+                    counts['deleted'] += 1
+                    persisted.append(('del', removed))
+            else:
+                counts['replaced' if registrations.add(record) else 'added'] += 1
+                persisted.append(('add', record))
+        persist_regs(persisted)
+        counts['registrations'] = len(registrations)
+        
+    log.info ('Bulk registration: %s', counts)
+    http_response(server, 200, json.dumps(counts), 'application/json')
+
+
+def proc_rehome(server):
+
+    # POST /api/register/rehome?from=<hub IP[:port]>&to=<hub IP[:port]>, after a hub's address has changed:
+    # moves its registrations to the new address in one transaction.  Without ports, every driver port
+    # registered at the old hub IP moves to the new IP unchanged.
+
+    if server.command != 'POST':
+        log.error ('Invalid method provided (%s) for rehome command', server.command)
+        http_response(server, 405, "")
+        return
+        
+    params = dict(urllib.parse.parse_qsl(server.query, keep_blank_values=True))
+    if set(params) != {'from', 'to'}:
+        log.error ('Rehome command needs exactly the from and to arguments')
+        http_response(server, 400, "")
+        return
+    oldhub = verify_addr(params['from'])
+    newhub = verify_addr(params['to'])
+    if not oldhub or not newhub or (newhub[1] and not oldhub[1]):
+        log.error ('Invalid hub addresses in rehome command: %s -> %s', params['from'], params['to'])
+        http_response(server, 400, "")
+        return
+        
+    with reglock:
+        moved = registrations.rehome(oldhub, newhub)
+        persist_regs([('add', record) for record in moved])
+        total = len(registrations)
+        
+    log.info ('Moved %s registration(s) from hub %s to %s', len(moved), params['from'], params['to'])
+    http_response(server, 200, json.dumps({'rehomed': len(moved), 'registrations': total}), 'application/json')
+
+
+ROUTES = {'/api/forward': 'forward', '/api/register': 'register', '/api/ping': 'ping',
+          '/api/register/bulk': 'bulk', '/api/register/rehome': 'rehome',
+          '/api/hubs': 'hubs', '/api/metrics': 'metrics', '/api/debug/profile': 'profile'}
+
+
+def route_request(server):
+
+    # Split the request target once, when the request line is parsed: server.route is the name of
+    # the API endpoint (None if the path is not one of ours) and server.query the raw query string
+    
+    path, _, server.query = server.path.partition('?')
+    if len(path) > 1 and path[-1] == '/':
+        path = path[:-1]
+    server.route = ROUTES.get(path) or ROUTES.get(path.lower())
+    server.target = None
+    return server.route
+
+
+def forward_url(server):
+
+    # The forward URL is everything after 'url=', so its own query string needs no escaping; a URL
+    # that was percent-encoded as a whole is decoded.  It may be preceded by timeout=<seconds>&, kept
+    # in server.fwtimeout.  The split URL is kept in server.target for build_headers.  Returns None if
+    # there is no usable http(s) URL.
+    
+    query = server.query
+    server.fwtimeout = None
+    if query.startswith('timeout='):
+        server.fwtimeout, _, query = query[8:].partition('&')
+    if not query.startswith('url='):
+        return None
+    url = query[4:]
+    if url[:6].lower() in ('http%3', 'https%'):
+        url = urllib.parse.unquote(url)
+    try:
+        target = urllib.parse.urlsplit(url)
+        if target.scheme.lower() not in ('http', 'https') or not target.hostname:
+            return None
+        target.port
+    except ValueError:
+        return None
+    server.target = target
+    return url
+
+
+def proc_hubs(server):
+
+    # Report the delivery health and circuit state of every hub messages have been sent to
+
+    if server.command == 'GET':
+        http_response(server, 200, json.dumps(hubstatus.stats(), indent=2), 'application/json')
+    else:
+        http_response(server, 405, "")
+
+
+def proc_metrics(server, pool):
+
+    # Prometheus scrape: the request metrics plus the counters the other subsystems already keep
+
+    extra = []
+    
+    with reglock:
+        regcount = len(registrations)
+        hubcount = len(registrations.byhub)
+    extra.append(('edgebridge_registrations', 'gauge', 'Registration records', [((), regcount)]))
+    extra.append(('edgebridge_registered_hubs', 'gauge', 'Distinct hub addresses with registrations', [((), hubcount)]))
+    
+    poolstats = pool.stats()
+    extra.append(('edgebridge_pool_requests_total', 'counter', 'Outbound requests, by whether a pooled connection was reused',
+                  [((('result', 'hit'),), poolstats['hits']), ((('result', 'miss'),), poolstats['misses'])]))
+    extra.append(('edgebridge_pool_hosts', 'gauge', 'Hosts with pooled outbound connections', [((), poolstats['hosts'])]))
+    
+    policy = fwpolicy.stats()
+    extra.append(('edgebridge_forward_retries_total', 'counter', 'GET forwards repeated after a failed attempt', [((), policy['retries'])]))
+    extra.append(('edgebridge_forward_hedged_total', 'counter', 'Hedged GET forwards: second requests sent, and those answered first',
+                  [((('result', 'sent'),), policy['hedged']), ((('result', 'won'),), policy['hedge_wins'])]))
+    
+    flights = coalescer.stats()
+    extra.append(('edgebridge_forward_coalescing_total', 'counter', 'GET forwards, by whether they went upstream or shared a response',
+                  [((('result', 'upstream'),), flights['upstream']), ((('result', 'coalesced'),), flights['coalesced'])]))
+    
+    if fwcache:
+        cachestats = fwcache.stats()
+        extra.append(('edgebridge_cache_lookups_total', 'counter', 'Forward response cache lookups, by result',
+                      [((('result', name),), cachestats[name]) for name in ('hits', 'revalidated', 'misses')]))
+        extra.append(('edgebridge_cache_evictions_total', 'counter', 'Forward response cache evictions', [((), cachestats['evictions'])]))
+        extra.append(('edgebridge_cache_entries', 'gauge', 'Forward response cache entries', [((), cachestats['entries'])]))
+    
+    if hubqueue:
+        queuestats = hubqueue.stats()
+        extra.append(('edgebridge_hub_queue_messages_total', 'counter', 'Hub delivery queue messages, by outcome',
+                      [((('outcome', name),), queuestats[name]) for name in ('enqueued', 'delivered', 'retries', 'dropped', 'rejected')]))
+        extra.append(('edgebridge_hub_queue_depth', 'gauge', 'Messages waiting in each hub delivery queue',
+                      [((('hub', hub),), depth) for hub, depth in queuestats['depth'].items()]))
+    
+    batches = hubbatches.stats()
+    if batches['received']:
+        extra.append(('edgebridge_hub_batch_messages_total', 'counter',
+                      'Device messages for registrations with batching: received, hub POSTs sent, and messages suppressed or batched into another',
+                      [((('outcome', name),), batches[name]) for name in ('received', 'sent', 'suppressed', 'batched')]))
+        extra.append(('edgebridge_hub_batch_device_messages_total', 'counter', 'Device messages suppressed or batched into another, by device',
+                      [((('device', device), ('outcome', name)), count) for device, counts in batches['devices'].items() for name, count in counts.items()]))
+        extra.append(('edgebridge_hub_batches_pending', 'gauge', 'Batches waiting for their window to close', [((), batches['pending'])]))
+    
+    hubs = hubstatus.stats()
+    extra.append(('edgebridge_hub_circuit_open', 'gauge', '1 if delivery to the hub is suspended (open or half-open circuit)',
+                  [((('hub', hub),), int(state['state'] != hubhealth.CLOSED)) for hub, state in hubs.items()]))
+    extra.append(('edgebridge_hub_latency_ewma_seconds', 'gauge', 'Smoothed hub delivery latency',
+                  [((('hub', hub),), state['latency_ms'] / 1000) for hub, state in hubs.items() if state['latency_ms'] is not None]))
+    
+    limits = [(scope, limiter.stats()) for scope, limiter in (('client', clientlimits), ('host', hostlimits)) if limiter]
+    if limits:
+        extra.append(('edgebridge_forward_throttled_total', 'counter', 'Forwards refused with a 429, by rate limit',
+                      [((('limit', scope),), limitstats['throttled']) for scope, limitstats in limits]))
+        extra.append(('edgebridge_forward_throttled_by_key_total', 'counter',
+                      'Forwards refused with a 429, for the most throttled clients and upstream hosts',
+                      [((('limit', scope), ('key', key)), count) for scope, limitstats in limits for key, count in limitstats['noisy'].items()]))
+    
+    extra.append(('edgebridge_log_dropped_total', 'counter', 'Log messages dropped because the log queue was full', [((), log.dropped)]))
+    
+    http_response(server, 200, reqmetrics.render(extra), 'text/plain; version=0.0.4; charset=utf-8')
+
+
+def profile_label(code):
+    
+    return f'{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}'
+
+
+def sample_threads(seconds):
+
+    # Samples the stacks of every other thread each PROFILE_INTERVAL; returns the sample count, the
+    # samples of running (not waiting) threads, and per function the running samples it was the
+    # innermost frame of (self) and those it was anywhere on the stack of (total)
+
+    me = threading.get_ident()
+    samples = running = 0
+    own = {}
+    total = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            samples += 1
+            if frame.f_code.co_name in PROFILE_IDLE:
+                continue
+            running += 1
+            label = profile_label(frame.f_code)
+            own[label] = own.get(label, 0) + 1
+            stack = set()
+            while frame is not None:
+                stack.add(frame.f_code)
+                frame = frame.f_back
+            for code in stack:
+                label = profile_label(code)
+                total[label] = total.get(label, 0) + 1
+        time.sleep(PROFILE_INTERVAL)
+    return samples, running, own, total
+
+
+def proc_profile(server):
+
+    # GET /api/debug/profile?seconds=<n>&top=<n>&trace=1, enabled by debug_profile: a sampling CPU
+    # profile of the bridge's threads over the next few seconds, the memory held by the registrations
+    # and, with trace=1, the allocation sites of memory allocated during the profile and still held.
+    # It runs on the requesting thread (an executor thread under asyncio) and blocks only that.
+
+    if not DEBUG_PROFILE:
+        log.error ('Profiling is not enabled (debug_profile)')
+        http_response(server, 404, "")
+        return
+    if server.command != 'GET':
+        http_response(server, 405, "")
+        return
+        
+    params = dict(urllib.parse.parse_qsl(server.query))
+    try:
+        seconds = float(params.get('seconds', DEFAULT_PROFILE_SECONDS))
+        top = int(params.get('top', 20))
+        if not 0 < seconds <= MAX_PROFILE_SECONDS or top < 1:
+            raise ValueError
+    except ValueError:
+        log.error ('Invalid profile arguments: %s', server.query)
+        http_response(server, 400, "")
+        return
+    trace = params.get('trace') in ('1', 'yes')
+    
+    log.info ('Profiling for %s seconds', seconds)
+    tracing = trace and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        samples, running, own, total = sample_threads(seconds)
+        allocations = tracemalloc.take_snapshot().statistics('lineno')[:top] if trace else None
+    finally:
+        if tracing:
+            tracemalloc.stop()
+        
+    with reglock:
+        regcount = len(registrations)
+        regbytes = registrations.footprint()
+        
+    ranked = lambda counts: [{'function': label, 'samples': count, 'percent': round(100 * count / running, 1)}
+                             for label, count in sorted(counts.items(), key=lambda item: -item[1])[:top]]
+    report = {'seconds': seconds, 'samples': samples, 'running': running,
+              'self': ranked(own), 'total': ranked(total),
+              'registrations': regcount, 'registration_bytes': regbytes,
+              'bytes_per_registration': round(regbytes / regcount) if regcount else None}
+    if allocations is not None:
+        report['allocations'] = [{'site': f'{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}',
+                                  'bytes': stat.size, 'blocks': stat.count} for stat in allocations]
+    http_response(server, 200, json.dumps(report, indent=2), 'application/json')
+
+
+def handle_requests(server):
+    
+    route = server.route
+    if route:
+        server.endpoint = route
+
+    if route == 'forward':
+        proc_forward(server, server.command)
+        
+    elif route == 'register':
+        proc_register(server, server.command)
+        
+    elif route == 'bulk':
+        proc_bulk_register(server)
+        
+    elif route == 'rehome':
+        proc_rehome(server)
+        
+    elif route == 'hubs':
+        proc_hubs(server)
+        
+    elif route == 'profile':
+        proc_profile(server)
+        
+    elif route == 'ping':
+        http_response(server, 200, "")
+        
+    else:
+        log.error ('Unregistered address or Invalid endpoint')
+        http_response(server, 404, "")
+
+
+def match_registrations(client_address):
+
+    # Collect the registration records for a device address; the caller does any hub I/O outside the lock
+
+    with reglock:
+        return registrations.match(client_address)
+
+
+def scrub_registrations():
+
+    # update registration list if exceeded pass-to-hub error threshold for any of the registration records
+    # -- this ensures that old no-longer-used ip:port hub addresses get scrubbed from list
+    
+    with reglock:
+        for item in regdeletelist:   
+            if registrations.find(item.devaddr, item.edgeid) is item:      # not since re-registered or moved
+                log.info ('Scrubbing registration record: %s', item)
+                registrations.remove(item.devaddr, item.edgeid)
+                persist_reg('del', item)
+                
+        regdeletelist.clear()
+
+
+def batch_messages(server, matches):
+
+    # Hands the message to hubbatches for registrations that batch their messages; returns the
+    # registrations to deliver it to now
+    
+    immediate = []
+    for record in matches:
+        if record.batch:
+            hubbatches.add(server, record)
+        else:
+            immediate.append(record)
+    return immediate
+
+
+def proc_registered_requests(server):
+    
+    # First see if this is a message from any registered devices
+
+    matches = match_registrations(server.client_address)
+    if matches:
+        server.endpoint = 'passthrough'
+        for record in matches:
+            log.info('>>>>> Forwarding to SmartThings hub')
+            
+        matches = batch_messages(server, matches)
+        if not matches:
+            http_response(server, 200, "")
+        elif hubqueue:
+            accepted = [record for record in matches if hubqueue.enqueue(server, record)]
+            http_response(server, 200 if accepted else 503, "")
+        elif HUB_ACK_IMMEDIATE:
+            http_response(server, 200, "")
+            send_to_hubs(server, matches)
+        else:
+            deliver_to_hubs(server, matches)
+            http_response(server, 200, "")
+        return True
+    
+    else:
+        return False
+        
+        
+def log_request_banner(server):
+
+    log.info ('**********************************************************************************')
+    if server.served > 1:
+        log.info ('%s request received from: %s (request %s on this connection)', server.command, server.client_address, server.served)
+    else:
+        log.info ('%s request received from: %s', server.command, server.client_address)
+    log.debug ('Endpoint: %s', server.path)
+
+
+def proc_msg(server):
+        
+    if not server.throttlechecked and forward_throttled(server):
+        return
+        
+    log_request_banner(server)
+    
+    # The body is read once, straight into the bytes object that every hub delivery then shares.
+    # In streaming mode a forward's body is left unread, to be piped upstream by stream_forward
+    
+    server.data_bytes = None
+    server.bodystream = None
+    
+    if 'chunked' in server.headers.get('Transfer-Encoding', '').lower():
+        try:
+            server.data_bytes = read_chunked(server.rfile, MAX_BODY_SIZE)
+        except OverflowError:
+            log.error ('Chunked request body over %s bytes refused', MAX_BODY_SIZE)
+            server.close_connection = True
+            http_response(server, 413, "")
+            return
+        except ValueError:
+            log.error ('Invalid chunked request body')
+            server.close_connection = True
+            http_response(server, 400, "")
+            return
+        server.bytes_in = len(server.data_bytes)
+        
+    elif 'Content-Length' in server.headers:
+        try:
+            length = int(server.headers['Content-Length'])
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            log.error ('Invalid Content-Length: %s', server.headers['Content-Length'])
+            server.close_connection = True
+            http_response(server, 400, "")
+            return
+        if not body_allowed(server, length):
+            log.error ('Request body of %s bytes refused (limit %s)', length, MAX_BODY_SIZE)
+            server.close_connection = True      # rather than read a body this large just to drop it
+            http_response(server, 413, "")
+            return
+        server.bytes_in = length
+        if length and body_streamed(server):
+            server.bodystream = bodyreader(server.rfile, length)
+        else:
+            server.data_bytes = server.rfile.read(length)
+        
+    if not proc_registered_requests(server):
+        handle_requests(server)
+        
+    if server.bodystream and server.bodystream.remaining:
+        # the body was never sent upstream: skip a small one to keep the connection, else give up on it
+        if server.bodystream.remaining > STREAM_CHUNK or not discard_body(server.rfile, server.bodystream.remaining):
+            server.close_connection = True
+
+
+class poolHTTPServer(http.server.HTTPServer):
+    
+    # Serves requests concurrently from a bounded pool of worker threads.
+    # When all workers are busy, the accept loop blocks until one frees up,
+    # so a burst of slow forwards cannot spawn an unbounded number of threads.
+    
+    daemon_threads = True
+    request_queue_size = 64
+    saturated = False                   # a new connection is waiting for a worker
+    
+    def __init__(self, server_address, RequestHandlerClass, workers):
+        
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='edgebridge')
+        self.slots = threading.BoundedSemaphore(workers)
+        super().__init__(server_address, RequestHandlerClass)
+        
+    def process_request(self, request, client_address):
+        
+        if not self.slots.acquire(blocking=False):
+            self.saturated = True           # idle keep-alive connections give up their workers
+            self.slots.acquire()
+            self.saturated = False
+        try:
+            self.pool.submit(self.__process_request_thread, request, client_address)
+        except RuntimeError:                # pool already shut down
+            self.slots.release()
+            self.shutdown_request(request)
+        
+    def __process_request_thread(self, request, client_address):
+        
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+            
+    def server_close(self):
+        
+        super().server_close()
+        self.saturated = True
+        self.pool.shutdown(wait=True)
+
+
+def create_server(server_address, handler, workers):
+    
+    if workers > 1:
+        return poolHTTPServer(server_address, handler, workers)
+    else:
+        return http.server.HTTPServer(server_address, handler)
+
+
+class myHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    # Speaks HTTP/1.1, so Edge drivers and devices can send many requests over one connection.
+    # Between requests a connection is kept open for up to KEEPALIVE_TIMEOUT seconds, and it is
+    # closed after KEEPALIVE_REQUESTS requests.  An idle connection gives up its worker thread
+    # early when another connection is waiting for one.
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1                       # buffered: headers and body go out in one write when the response is flushed
+    disable_nagle_algorithm = True
+    timeout = CLIENT_TIMEOUT
+    
+    def setup(self):
+        
+        super().setup()
+        self.served = 0
+        self.connection_header = False
+        reqmetrics.connection_opened()
+        
+    def handle(self):
+        
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.__await_request():
+            self.handle_one_request()
+            
+    def __await_request(self):
+        
+        # Wait for the next request on a kept-alive connection; False to close the connection instead
+        
+        sock = self.connection
+        sock.setblocking(False)
+        try:
+            if self.rfile.peek(1):          # pipelined request already buffered, or already arrived
+                return True
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(self.timeout)
+            
+        deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+        while not getattr(self.server, 'saturated', True):
+            wait = min(deadline - time.monotonic(), KEEPALIVE_POLL)
+            if wait <= 0:
+                break
+            if select.select([sock], [], [], wait)[0]:
+                return True
+        log.debug ('Closing idle connection from %s after %s request(s)', self.client_address, self.served)
+        return False
+        
+    def finish(self):
+        
+        try:
+            super().finish()
+        finally:
+            reqmetrics.connection_closed()
+            
+    def parse_request(self):
+        
+        self.throttlechecked = False        # set if handle_expect_100 already took this request's rate limit token
+        if not super().parse_request():
+            return False
+        self.served += 1
+        if self.served > 1:
+            reqmetrics.connection_reused()
+        if KEEPALIVE_TIMEOUT <= 0 or self.served >= KEEPALIVE_REQUESTS:
+            self.close_connection = True
+        route_request(self)
+        return True
+        
+    def handle_expect_100(self):
+        
+        # A client that waits for 100 Continue is told now if its forward is over a rate limit or its
+        # body is too large, before sending it, as the asyncio engine does
+        
+        route_request(self)
+        if forward_throttled(self):
+            return False
+        self.throttlechecked = True
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = 0                      # proc_msg answers an invalid Content-Length
+        if not body_allowed(self, length):
+            log.error ('Request body of %s bytes refused (limit %s)', length, MAX_BODY_SIZE)
+            self.close_connection = True
+            http_response(self, 413, "")
+            return False
+        super().handle_expect_100()
+        self.wfile.flush()                  # wfile is buffered; the client is waiting for this
+        return True
+        
+    def send_response(self, code, message=None):
+        
+        # Replaces the base class's per-response Server/Date formatting (and request logging)
+        
+        self.status = code
+        self.connection_header = False
+        self.send_response_only(code, message)
+        self.send_header('Server', SERVER_HEADER)
+        self.send_header('Date', http_date())
+        
+    def send_header(self, keyword, value):
+        
+        if keyword.lower() == 'connection':
+            self.connection_header = True
+        super().send_header(keyword, value)
+        
+    def end_headers(self):
+        
+        # Tell the client whether the connection stays open (HTTP/1.1 assumes it does, HTTP/1.0 that it doesn't)
+        if not self.connection_header:
+            if self.close_connection:
+                if self.request_version == 'HTTP/1.1':
+                    self.send_header('Connection', 'close')
+            elif self.request_version != 'HTTP/1.1':
+                self.send_header('Connection', 'keep-alive')
+        super().end_headers()
+        
+    def __measured(self, process):
+        
+        start = time.perf_counter()
+        self.endpoint = 'other'
+        self.status = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        try:
+            process(self)
+        finally:
+            reqmetrics.request(self.endpoint, self.command, self.status, time.perf_counter() - start,
+                               self.bytes_in, self.bytes_out)
+            
+    def __ping(self):
+        
+        self.endpoint = 'ping'
+        log.debug ('Pingreq')
+        http_response(self, 200, "")
+        
+    def do_POST(self):
+        
+        # If a ping, just send response and don't display any messages
+        if self.route == 'ping':
+            self.__measured(myHTTPRequestHandler.__ping)
+            
+        else:
+            self.__measured(proc_msg)
+            
+            
+    def do_PUT(self):
+        
+        self.__measured(proc_msg)
+        
+        
+    def do_GET(self):
+        
+        if self.route == 'metrics':
+            self.endpoint = 'metrics'
+            proc_metrics(self, outbound)
+        else:
+            self.__measured(proc_msg)
+        
+
+    def do_DELETE(self):
+        
+        self.__measured(proc_msg)
+        
+
+    def log_message(self, format, *args):
+        return
+
+
+class asyncRequest(object):
+    
+    # Gives an asyncio connection the handler attributes that the request processing functions
+    # (http_response, build_headers, proc_register, hub_request) use.  The response is buffered
+    # in wfile and written out by the engine once processing completes.
+    
+    def __init__(self, command, path, headers, client_address, request_version='HTTP/1.0', keepalive=False, served=1):
+        
+        self.command = command
+        self.path = path
+        self.headers = headers
+        self.client_address = client_address
+        self.request_version = request_version
+        self.close_connection = not keepalive
+        self.served = served
+        self.data_bytes = None
+        self.bodystream = None
+        self.wfile = io.BytesIO()
+        self.endpoint = 'other'
+        self.status = 0
+        self.bytes_out = 0
+        route_request(self)
+        
+    def send_response(self, code, message=None):
+        
+        self.status = code
+        try:
+            reason = http.HTTPStatus(code).phrase
+        except ValueError:
+            reason = ''
+        version = 'HTTP/1.1' if self.request_version == 'HTTP/1.1' else 'HTTP/1.0'
+        self.wfile.write(f'{version} {code} {reason}\r\nDate: {http_date()}\r\n'.encode('latin-1'))
+        self.wfile.write(STATIC_HEADERS)
+        
+    def send_header(self, keyword, value):
+        
+        self.wfile.write(f'{keyword}: {value}\r\n'.encode('latin-1'))
+        
+    def end_headers(self):
+        
+        if self.close_connection:
+            if self.request_version == 'HTTP/1.1':
+                self.send_header('Connection', 'close')
+        elif self.request_version != 'HTTP/1.1':
+            self.send_header('Connection', 'keep-alive')
+        self.wfile.write(b'\r\n')
+
+
+class asyncclient(object):
+    
+    # Minimal non-blocking HTTP/1.1 client for the asyncio engine, with per-host keep-alive reuse
+    
+    def __init__(self, idle_timeout):
+        
+        self.idle_timeout = idle_timeout
+        self.idle = {}                      # (scheme, host, port) -> [(reader, writer, last used)]
+        self.hits = 0
+        self.misses = 0
+        self.sslcontext = None
+        
+    async def __connect(self, key):
+        
+        now = time.monotonic()
+        conns = self.idle.get(key, [])
+        while conns:
+            reader, writer, lastused = conns.pop()
+            if writer.is_closing() or reader.at_eof() or now - lastused > self.idle_timeout:
+                writer.close()
+                continue
+            self.hits += 1
+            return reader, writer, True
+        
+        scheme, host, port = key
+        if scheme == 'https':
+            if self.sslcontext is None:
+                self.sslcontext = ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(host, port, ssl=self.sslcontext)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        self.misses += 1
+        return reader, writer, False
+    
+    async def __readresponse(self, reader, method):
+        
+        statusline = await reader.readline()
+        if not statusline:
+            raise ConnectionResetError('Connection closed by server')
+        version, status = statusline.split(None, 2)[:2]
+        status = int(status)
+        
+        headerlines = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            headerlines.append(line)
+        headers = http.client.parse_headers(io.BytesIO(b''.join(headerlines) + b'\r\n'))
+        
+        reusable = version == b'HTTP/1.1' and headers.get('Connection', '').lower() != 'close'
+        
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                size = chunk_size(await reader.readline())
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'Content-Length' in headers:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            body = await reader.read()
+            reusable = False
+            
+        return status, headers, body, reusable
+        
+    async def __exchange(self, method, url, headers, data, connect_timeout):
+        
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+            
+        lines = [f'{method} {target} HTTP/1.1']
+        for name, value in headers.items():
+            if name.lower() not in ('accept-encoding', 'connection', 'content-length'):
+                lines.append(f'{name}: {value}')
+        lines.append('Accept-Encoding: identity')
+        lines.append('Connection: keep-alive')
+        lines.append(f'Content-Length: {len(data) if data else 0}')
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')    # the body is written as is, not copied onto this
+        
+        while True:
+            reader, writer, reused = await asyncio.wait_for(self.__connect(key), connect_timeout)
+            try:
+                writer.write(head)
+                if data:
+                    writer.write(data)
+                await writer.drain()
+                status, rheaders, body, reusable = await self.__readresponse(reader, method)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:                  # stale keep-alive connection; retry on a fresh one
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            break
+            
+        if reusable:
+            self.idle.setdefault(key, []).append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+            
+        return status, rheaders, body
+        
+    async def request(self, method, url, headers, data, timeout, connect_timeout=None):
+        
+        return await asyncio.wait_for(self.__exchange(method.upper(), url, headers, data, connect_timeout), timeout)
+        
+    def stats(self):
+        
+        return {'hosts': len(self.idle), 'hits': self.hits, 'misses': self.misses}
+        
+    def close(self):
+        
+        for conns in self.idle.values():
+            for reader, writer, lastused in conns:
+                writer.close()
+        self.idle.clear()
+
+
+async def async_proc_forward(server, client, method):
+
+    url = forward_url(server)
+    if not url:
+        log.error ('Missing or invalid URL in forward command')
+        http_response(server, 400, "")
+        return
+        
+    log.info ('Sending %s to %s', method, url)
+    
+    headers = build_headers(server)
+    
+    log.debug ('Headers: %s', headers)
+    if server.data_bytes:
+        if log.debugging:
+            log.debug ('Body (%s bytes): %s', len(server.data_bytes), server.data_bytes[:LOG_BODY_MAX].decode("utf-8", errors="replace"))
+        
+    if method.lower() not in ['post', 'put', 'get']:
+        log.error ('Unsupported forward method: %s', method)
+        http_response(server, 405, "")
+        return
+        
+    timing = fwpolicy.timing(server)
+    if not timing:
+        log.error ('Invalid forward timeout: %s', server.fwtimeout or server.headers.get('X-Edgebridge-Timeout'))
+        http_response(server, 400, "")
+        return
+        
+    cachekey = fwcache.key(method, url, headers) if fwcache and not FORWARD_STREAMING and not server.data_bytes else None
+    if cachekey:
+        entry, fresh = fwcache.lookup(cachekey)
+        if fresh:
+            sent = http_response(server, 200, entry['text'])
+            log.info ('Cached response returned to Edge driver (bytes len=%s)', sent)
+            return
+        if entry:
+            headers.update(fwcache.conditional_headers(entry))
+        
+    def attempt(connect, read):
+        return client.request(method, url, headers, server.data_bytes, read, connect)
+        
+    start = time.perf_counter()
+    try:
+        flightkey = singleflight.key(method, url, headers) if FORWARD_COALESCING and not server.data_bytes else None
+        if flightkey:
+            status, rheaders, body = await coalescer.async_do(flightkey, lambda: fwpolicy.async_run(attempt, True, timing), timing[2])
+        else:
+            status, rheaders, body = await fwpolicy.async_run(attempt, method.lower() == 'get', timing)
+        reqmetrics.forward_upstream(time.perf_counter() - start)
+        if log.debugging:
+            log.debug ('Connection pool: %s', client.stats())
+    except asyncio.TimeoutError:
+        log.error ("Internet request timed out")
+        http_response(server, 504, "")
+        return
+    except (OSError, ValueError, asyncio.IncompleteReadError) as err:
+        log.error ('Internet request failed: %s', err)
+        http_response(server, 502, "")
+        return
+        
+    if status == HTTP_OK and FORWARD_STREAMING:
+        server.send_response(200)
+        for name in ('Content-Type', 'Content-Encoding'):
+            if name in rheaders:
+                server.send_header(name, rheaders[name])
+        server.send_header("Content-Length", str(len(body)))
+        server.end_headers()
+        server.wfile.write(body)
+        server.bytes_out = len(body)
+        log.info ('Response returned to Edge driver (bytes len=%s)', len(body))
+        
+    elif status == HTTP_OK:
+        text = body.decode(rheaders.get_content_charset() or 'utf-8', errors='replace')
+        log.debug ('Returned data: %s', text)
+        sent = http_response(server, 200, text)
+        log.info ('Response returned to Edge driver (bytes len=%s)', sent)
+        if cachekey:
+            fwcache.store(cachekey, rheaders, text)
+            
+    elif status == 304 and cachekey and entry:
+        fwcache.refresh(cachekey, entry, rheaders)
+        sent = http_response(server, 200, entry['text'])
+        log.info ('Revalidated cached response returned to Edge driver (bytes len=%s)', sent)
+        
     else:
-        return False
-
-    return id
+        log.warn ('HTTP error returned: %s', status)
+        http_response(server, status, "")
 
 
-def find_reg(reglist, devaddr, edgeid):
+async def async_passto_hub(server, client, regrecord):
 
-    for index in range(len(reglist)):
-        if reglist[index]['devaddr'] == devaddr:
-            if reglist[index]['edgeid'] == edgeid:
-                return(index)
+    url, headers, hubaddr = hub_request(server, regrecord)
 
-    return None
-
-def read_regs(regs_filename):
+    if not hubstatus.allow(regrecord.hubaddr):
+        log.warn ('Edge hub %s is not responding; message not sent', hubaddr)
+        return regrecord, 'circuit open', 0
 
-    file_path = os.getcwd() + os.path.sep + regs_filename
+    log.info ('Sending POST: %s to %s', url, hubaddr)
 
+    start = time.monotonic()
     try:
-        with open(file_path,"r") as f1:
-
-            reglist = []
-            lines = f1.readlines()
-            for line in lines:
-                reglist.append(json.loads(line))
-            return reglist
-            
-    except:
-        log.warn ('INFO: No existing registrations')
-        return []
-
-def write_regs(regs_filename, reglist):
+        status, rheaders, body = await client.request('POST', url, headers, server.data_bytes, HUB_TIMEOUT)
 
-    file_path = os.getcwd() + os.path.sep + regs_filename
+        if status == 200:
+            log.info ("Message forwarded to Edge ID %s", regrecord.edgeid)
+            outcome = 'ok'
+        else:
+            log.error ("ERROR sending message to Edge hub %s: %s", regrecord.hubaddr, status)
+            outcome = f'HTTP {status}'
+        record_hub_response(regrecord.hubaddr, status, time.monotonic() - start)
+    except asyncio.TimeoutError:
+        log.error ("TIMED OUT sending message to Edge hub %s", regrecord.hubaddr)
+        error_proc(regrecord.hubaddr)
+        outcome = 'timeout'
+    except Exception:
+        log.error ("FAILED sending message to Edge hub %s", regrecord.hubaddr)
+        error_proc(regrecord.hubaddr)
+        outcome = 'failed'
+        
+    latency = time.monotonic() - start
+    reqmetrics.hub_delivery(latency)
+    return regrecord, outcome, latency
 
-    try:
-        with open(file_path, 'w') as f1:
-            for reg in reglist:
-                f1.write(json.dumps(reg)+'\n')
-    except:
-        log.error ('Error saving registrations')
 
+backgroundtasks = set()                 # keeps early-acknowledged deliveries referenced until done
 
-def proc_register(server, method, arglist):
-   
-    for arg in arglist:
-        if arg.startswith('devaddr='):
-            devaddr = verify_addr(arg[8:])
-        elif arg.startswith('hubaddr='):
-            hubaddr = verify_addr(arg[8:])
-        elif arg.startswith('edgeid='):
-            edgeid = verify_ID(arg[7:])
-        else:
-            log.error ('Unrecognized argument in register command')
-            http_response(server, 400, "")
-            return
 
-    if devaddr and hubaddr and edgeid:
+async def async_deliver_to_hubs(server, client, matches):
 
-        index = find_reg(registrations, devaddr, edgeid)
+    report_delivery(await asyncio.gather(*(async_passto_hub(server, client, record) for record in matches)))
+    scrub_registrations()
 
-        if method in ['post', 'Post', 'POST']:
-            log.info (f'Request to register device at {devaddr}')
-            
-            if index == None:
-                registrations.append({'devaddr': devaddr, 'edgeid': edgeid, 'hubaddr': hubaddr})
-                log.info ('Registration record ADDED')
-               
-            else:
-                registrations[index] = {'devaddr': devaddr, 'edgeid': edgeid, 'hubaddr': hubaddr}
-                log.info ('Existing registration was REPLACED')
 
-            http_response(server, 200, "")
-            
-        elif method in ['delete', 'Delete', 'DELETE']:
-            log.info (f'Request to remove registration {devaddr}')
+async def async_proc_msg(server, client):
 
-            if index != None:
-                del registrations[index]
-                log.info (f'Registration {index} DELETED')
-                http_response(server, 200, "")
-            else:
-                log.warn (f'Request to remove address that is not registered: {devaddr}')
-                http_response(server, 404, "")
-        else:
-            log.error (f'Invalid method provided ({method}) for register command')
-            http_response(server, 405, "")
-    else:
-        log.error ('Missing argument(s) in register command')
-        http_response(server, 400, "")
+    # If a ping, just send response and don't display any messages
+    if server.command == 'POST' and server.route == 'ping':
+        server.endpoint = 'ping'
+        log.debug ('Pingreq')
+        http_response(server, 200, "")
+        return
     
-    log.info (f'Updated registrations: {registrations}')
-    write_regs(REGSFILENAME, registrations)
-
+    if server.command == 'GET' and server.route == 'metrics':
+        server.endpoint = 'metrics'
+        proc_metrics(server, client)
+        return
 
-def handle_requests(server):
+    log_request_banner(server)
     
-    method = server.command
-    path = server.path
-
-    if '?' in path:
-        arg = path.split('?')
-        if arg:
-            endpoint = arg[0].split('/')
-            arglist = arg[1].split('&')
-
-            if endpoint[1] in ['api', 'API']:
-                if endpoint[2] in ['forward','Forward','FORWARD']:
-                    proc_forward(server, method, path, arglist[0])   
-                        
-                elif endpoint[2] in ['register','Register','REGISTER']:
-                    proc_register(server, method, arglist)
-                    
-                else:
-                    log.warn ('Invalid endpoint')
-                    http_response(server, 404, "")
-            else:
-                log.error ('Not an API request')
-                http_response(server, 404, "")
+    matches = match_registrations(server.client_address)
+    if matches:
+        server.endpoint = 'passthrough'
+        for record in matches:
+            log.info('>>>>> Forwarding to SmartThings hub')
+        matches = batch_messages(server, matches)
+        if not matches:
+            http_response(server, 200, "")
+        elif hubqueue:
+            accepted = [record for record in matches if hubqueue.enqueue(server, record)]
+            http_response(server, 200 if accepted else 503, "")
+        elif HUB_ACK_IMMEDIATE:
+            http_response(server, 200, "")
+            task = asyncio.ensure_future(async_deliver_to_hubs(server, client, matches))
+            backgroundtasks.add(task)
+            task.add_done_callback(backgroundtasks.discard)
         else:
-            log.error ('Invalid endpoint')
-            http_response(server, 400, "")
-    else:
-        log.error ('Unregistered address or Invalid endpoint')
-        http_response(server, 400, "")
-
-
-def proc_registered_requests(server):
-    
-    global regdeletelist
-    global registrations
-    regfound = False
+            await async_deliver_to_hubs(server, client, matches)
+            http_response(server, 200, "")
+        return
+        
+    if server.route == 'forward':
+        server.endpoint = 'forward'
+        await async_proc_forward(server, client, server.command)
+        return
+        
+    if server.route == 'profile':
+        server.endpoint = 'profile'
+        await asyncio.get_running_loop().run_in_executor(None, proc_profile, server)     # the loop keeps serving, and is profiled
+        return
+            
+    handle_requests(server)
 
-    # First see if this is a message from any registered devices
 
-    for record in registrations:
-        match = False
-        if record['devaddr'][0] == server.client_address[0]:
-            match = True
-            if record['devaddr'][1]:
-                if record['devaddr'][1] != server.client_address[1]:
-                    match = False
-            if match:
-                regfound = True
-                log.info('>>>>> Forwarding to SmartThings hub')
-                passto_hub(server, record)
-                
-    if regfound:
-        http_response(server, 200, "")
-        
-        # update registration list if exceeded pass-to-hub error threshold for any of the registration records
-        # -- this ensures that old no-longer-used ip:port hub addresses get scrubbed from list
-        for item in regdeletelist:   
-            log.info (f'Scrubbing registration record: {item}')   
-            registrations.remove(item)
-                
-        if len(regdeletelist) > 0:
-            write_regs(REGSFILENAME, registrations)
-            regdeletelist.clear() 
+class asyncBridge(object):
     
-        return True
+    # asyncio server core: serves the same endpoints as myHTTPRequestHandler, but forwards and
+    # hub deliveries are non-blocking so many can be in flight on a single thread
     
-    else:
-        return False
+    def __init__(self, server_address, idle_timeout=DEFAULT_POOL_IDLE):
         
+        self.server_address = server_address
+        self.client = asyncclient(idle_timeout)
+        self.server = None
         
-def proc_msg(server):
-        
-    log.info ('**********************************************************************************')
-    log.info (f'{server.command} request received from: {server.client_address}')
-    log.debug (f'Endpoint: {server.path}')
-    
-    server.data_bytes = None
-    if 'Content-Length' in server.headers:
-        server.data_bytes = server.rfile.read(int(server.headers['Content-Length']))
-        
-    if not proc_registered_requests(server):
-        handle_requests(server)
-
-
-class myHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-
-    def do_POST(self):
+    async def __connection(self, reader, writer):
         
-        # If a ping, just send response and don't display any messages
-        if '/api/ping' in self.path:
-            log.debug ('Pingreq')
-            http_response(self, 200, "")
-            return
+        # Serves requests on the connection in order until the client closes it, it has been idle
+        # for KEEPALIVE_TIMEOUT seconds or it has served KEEPALIVE_REQUESTS requests
         
-        else:
-            proc_msg(self)
+        reqmetrics.connection_opened()
+        served = 0
+        try:
+            while True:
+                requestline = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT if served else CLIENT_TIMEOUT)
+                words = requestline.decode('latin-1').split()
+                if not words:
+                    return
+                if len(words) != 3 or not words[2].startswith('HTTP/'):
+                    log.error ('Bad request line: %s', requestline.strip()[:LOG_BODY_MAX])
+                    await self.__refuse(writer, 400)
+                    return
+                command, path, version = words
+                
+                headerlines = []
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), CLIENT_TIMEOUT)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    headerlines.append(line)
+                headers = http.client.parse_headers(io.BytesIO(b''.join(headerlines) + b'\r\n'))
+                if command not in SERVER_METHODS:
+                    log.error ('Unsupported method: %s', command)
+                    await self.__refuse(writer, 501, version)
+                    return
+                
+                served += 1
+                if served > 1:
+                    reqmetrics.connection_reused()
+                conntype = headers.get('Connection', '').lower()
+                keepalive = KEEPALIVE_TIMEOUT > 0 and served < KEEPALIVE_REQUESTS and \
+                            (conntype != 'close' if version == 'HTTP/1.1' else conntype == 'keep-alive')
+                
+                server = asyncRequest(command, path, headers, writer.get_extra_info('peername')[:2], version, keepalive, served)
+                start = time.perf_counter()
+                if not forward_throttled(server):
+                    try:
+                        chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+                        length = 0 if chunked else int(headers.get('Content-Length', 0))
+                        if length < 0:
+                            raise ValueError
+                        if length > MAX_BODY_SIZE:
+                            raise OverflowError(length)
+                        if (chunked or length) and version == 'HTTP/1.1' and headers.get('Expect', '').lower() == '100-continue':
+                            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                        if chunked:
+                            server.data_bytes = await async_read_chunked(reader, MAX_BODY_SIZE)
+                        elif length:
+                            server.data_bytes = await asyncio.wait_for(reader.readexactly(length), CLIENT_TIMEOUT)
+                    except OverflowError as err:
+                        log.error ('Request body of %s bytes refused (limit %s)', err, MAX_BODY_SIZE)
+                        server.close_connection = True
+                        http_response(server, 413, "")
+                    except ValueError:
+                        log.error ('Invalid request body length or chunk encoding')
+                        server.close_connection = True
+                        http_response(server, 400, "")
+                    else:
+                        await async_proc_msg(server, self.client)
+                    
+                if server.endpoint != 'metrics':
+                    reqmetrics.request(server.endpoint, command, server.status, time.perf_counter() - start,
+                                       len(server.data_bytes or b''), server.bytes_out)
+                
+                writer.write(server.wfile.getvalue())
+                await writer.drain()
+                if server.close_connection:
+                    return
             
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except Exception as err:
+            log.error (f'Error processing request: {err}')
+        finally:
+            writer.close()
+            reqmetrics.connection_closed()
             
-    def do_PUT(self):
+    async def __refuse(self, writer, code, version='HTTP/1.0'):
         
-        proc_msg(self)
+        # Answers a request that cannot be processed, as BaseHTTPRequestHandler.send_error does, and
+        # the connection is closed after it
         
+        server = asyncRequest('', '', {}, writer.get_extra_info('peername')[:2], version)
+        http_response(server, code, "")
+        writer.write(server.wfile.getvalue())
+        await writer.drain()
         
-    def do_GET(self):
+    async def start(self):
         
-        proc_msg(self)
+        host, port = self.server_address
+        self.server = await asyncio.start_server(self.__connection, host or None, port, reuse_address=True)
+        self.server_address = self.server.sockets[0].getsockname()[:2]
         
-
-    def do_DELETE(self):
+    async def serve_forever(self):
         
-        proc_msg(self)
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+            
+    async def stop(self):
         
-
-    def log_message(self, format, *args):
-        return
+        self.server.close()
+        await self.server.wait_closed()
+        self.client.close()
 
 
 def process_config(config_filename):
@@ -524,13 +3704,65 @@ def process_config(config_filename):
     global SERVER_PORT
     global SERVER_IP
     global SMARTTHINGS_TOKEN
+    global FWTIMEOUT
+    global FW_CONNECT_TIMEOUT
+    global SERVER_THREADS
+    global SERVER_ENGINE
+    global HUB_TIMEOUT
+    global HUB_ACK_IMMEDIATE
+    global FORWARD_STREAMING
+    global FORWARD_COALESCING
+    global DEBUG_PROFILE
+    global KEEPALIVE_TIMEOUT
+    global KEEPALIVE_REQUESTS
+    global MAX_BODY_SIZE
+    global hubqueue
+    global hubstatus
+    global fwcache
+    global fwpolicy
+    global clientlimits
+    global hostlimits
+    global outbound
     global log
     
     SERVER_IP = ''
     SERVER_PORT = DEFAULT_SERVERPORT
     SMARTTHINGS_TOKEN = DEFAULT_ST_TOKEN
+    FWTIMEOUT = DEFAULT_FWTIMEOUT
+    FW_CONNECT_TIMEOUT = DEFAULT_FW_CONNECT_TIMEOUT
+    forward_retries = 0
+    forward_hedge_after = 0
+    forward_hosts = {}
+    SERVER_THREADS = DEFAULT_SERVER_THREADS
+    SERVER_ENGINE = DEFAULT_SERVER_ENGINE
+    KEEPALIVE_TIMEOUT = DEFAULT_KEEPALIVE_TIMEOUT
+    KEEPALIVE_REQUESTS = DEFAULT_KEEPALIVE_REQUESTS
+    MAX_BODY_SIZE = DEFAULT_MAX_BODY_SIZE
+    HUB_TIMEOUT = DEFAULT_HUB_TIMEOUT
+    HUB_ACK_IMMEDIATE = False
+    FORWARD_STREAMING = False
+    DEBUG_PROFILE = False
+    fwcache = None
+    FORWARD_COALESCING = True
+    clientlimits = None
+    hostlimits = None
+    queue_enabled = False
+    queue_depth = DEFAULT_HUB_QUEUE_DEPTH
+    queue_retries = DEFAULT_HUB_RETRIES
+    queue_backoff = DEFAULT_HUB_BACKOFF
+    queue_spool = False
+    hub_failures = DEFAULT_HUB_FAILURES
+    hub_open_secs = DEFAULT_HUB_OPEN_SECS
+    hub_scrub_secs = DEFAULT_HUB_SCRUB_SECS
+    pool_size = DEFAULT_POOL_SIZE
+    pool_idle = DEFAULT_POOL_IDLE
     conoutp = True
     logoutp = False
+    logmaxbytes = 0
+    logrotatesecs = 0
+    logbackups = 3
+    logqueuesize = 10000
+    loglevel = logger.INFO
     LOGFILE = ''
 
     CONFIG_FILE_PATH = os.getcwd() + os.path.sep + config_filename
@@ -569,8 +3801,201 @@ def process_config(config_filename):
             pass
            
         try:    
-            if parser.get('config', 'forwarding_timeout'):
-                FWTIMEOUT = int(parser.get('config', 'forwarding_timeout'))
+            config_fwtimeout = float(parser.get('config', 'forwarding_timeout'))
+            if config_fwtimeout > 0:
+                FWTIMEOUT = config_fwtimeout
+            else:
+                print (f'\033[31mInvalid forwarding_timeout from config file; using default: {DEFAULT_FWTIMEOUT}\033[0m')
+        except:
+            pass
+        
+        try:
+            config_connect = float(parser.get('config', 'forward_connect_timeout'))
+            if config_connect > 0:
+                FW_CONNECT_TIMEOUT = config_connect
+            else:
+                print (f'\033[31mInvalid forward_connect_timeout from config file; using default: {DEFAULT_FW_CONNECT_TIMEOUT}\033[0m')
+        except:
+            pass
+        
+        try:
+            forward_retries = max(int(parser.get('config', 'forward_retries')), 0)
+        except:
+            pass
+        
+        try:
+            forward_hedge_after = max(float(parser.get('config', 'forward_hedge_after')), 0) / 1000
+        except:
+            pass
+        
+        # [timeouts] section: <host> = <read timeout> or <host> = <connect timeout>, <read timeout>
+        if parser.has_section('timeouts'):
+            for host, value in parser.items('timeouts'):
+                try:
+                    values = [float(item) for item in value.split(',')]
+                    if len(values) not in (1, 2) or min(values) <= 0:
+                        raise ValueError
+                    forward_hosts[host.lower()] = (values[0] if len(values) == 2 else None, values[-1])
+                except ValueError:
+                    print (f'\033[31mInvalid timeouts for {host} from config file; using defaults\033[0m')
+        
+        try:
+            config_threads = int(parser.get('config', 'server_threads'))
+            if config_threads > 0:
+                SERVER_THREADS = config_threads
+            else:
+                print (f'\033[31mInvalid server_threads from config file; using default: {DEFAULT_SERVER_THREADS}\033[0m')
+        except:
+            pass
+        
+        try:
+            config_engine = parser.get('config', 'server_engine').lower()
+            if config_engine in ['threaded', 'asyncio']:
+                SERVER_ENGINE = config_engine
+            else:
+                print (f'\033[31mInvalid server_engine from config file; using default: {DEFAULT_SERVER_ENGINE}\033[0m')
+        except:
+            pass
+        
+        try:
+            KEEPALIVE_TIMEOUT = max(float(parser.get('config', 'keepalive_timeout')), 0)
+        except:
+            pass
+        
+        try:
+            config_keepalive = int(parser.get('config', 'keepalive_requests'))
+            if config_keepalive > 0:
+                KEEPALIVE_REQUESTS = config_keepalive
+            else:
+                print (f'\033[31mInvalid keepalive_requests from config file; using default: {DEFAULT_KEEPALIVE_REQUESTS}\033[0m')
+        except:
+            pass
+        
+        try:
+            config_bodysize = int(float(parser.get('config', 'max_body_size')) * 1024)
+            if config_bodysize > 0:
+                MAX_BODY_SIZE = config_bodysize
+            else:
+                print (f'\033[31mInvalid max_body_size from config file; using default: {DEFAULT_MAX_BODY_SIZE // 1024}\033[0m')
+        except:
+            pass
+        
+        try:
+            config_hubtimeout = float(parser.get('config', 'hub_timeout'))
+            if config_hubtimeout > 0:
+                HUB_TIMEOUT = config_hubtimeout
+            else:
+                print (f'\033[31mInvalid hub_timeout from config file; using default: {DEFAULT_HUB_TIMEOUT}\033[0m')
+        except:
+            pass
+        
+        try:
+            HUB_ACK_IMMEDIATE = parser.get('config', 'hub_ack_immediate').lower() == 'yes'
+        except:
+            pass
+        
+        try:
+            queue_enabled = parser.get('config', 'hub_delivery_queue').lower() == 'yes'
+        except:
+            pass
+        
+        try:
+            queue_depth = max(int(parser.get('config', 'hub_queue_depth')), 1)
+        except:
+            pass
+        
+        try:
+            queue_retries = max(int(parser.get('config', 'hub_retries')), 0)
+        except:
+            pass
+        
+        try:
+            queue_backoff = max(float(parser.get('config', 'hub_retry_backoff')), 0)
+        except:
+            pass
+        
+        try:
+            queue_spool = parser.get('config', 'hub_spool').lower() == 'yes'
+        except:
+            pass
+        
+        try:
+            config_failures = int(parser.get('config', 'hub_failure_threshold'))
+            if config_failures > 0:
+                hub_failures = config_failures
+            else:
+                print (f'\033[31mInvalid hub_failure_threshold from config file; using default: {DEFAULT_HUB_FAILURES}\033[0m')
+        except:
+            pass
+        
+        try:
+            hub_open_secs = max(float(parser.get('config', 'hub_retry_after')), 0)
+        except:
+            pass
+        
+        try:
+            hub_scrub_secs = max(float(parser.get('config', 'hub_scrub_minutes')), 0) * 60
+        except:
+            pass
+        
+        try:
+            FORWARD_STREAMING = parser.get('config', 'forward_streaming').lower() == 'yes'
+        except:
+            pass
+        
+        try:
+            DEBUG_PROFILE = parser.get('config', 'debug_profile').lower() == 'yes'
+        except:
+            pass
+        
+        try:
+            FORWARD_COALESCING = parser.get('config', 'forward_coalescing').lower() != 'no'
+        except:
+            pass
+        
+        try:
+            if parser.get('config', 'forward_cache').lower() == 'yes':
+                cache_ttl = DEFAULT_CACHE_TTL
+                cache_size = DEFAULT_CACHE_SIZE
+                try:
+                    cache_ttl = float(parser.get('config', 'forward_cache_ttl'))
+                except:
+                    pass
+                try:
+                    cache_size = int(parser.get('config', 'forward_cache_size'))
+                except:
+                    pass
+                fwcache = responsecache(cache_ttl, max(cache_size, 1))
+        except:
+            pass
+        
+        for scope in ('client', 'host'):
+            try:
+                rate = float(parser.get('config', f'forward_rate_per_{scope}'))
+                if rate > 0:
+                    burst = DEFAULT_RATE_BURST
+                    try:
+                        burst = int(parser.get('config', f'forward_burst_per_{scope}'))
+                    except:
+                        pass
+                    if scope == 'client':
+                        clientlimits = ratelimiter(rate, burst)
+                    else:
+                        hostlimits = ratelimiter(rate, burst)
+            except:
+                pass
+        
+        try:
+            config_poolsize = int(parser.get('config', 'connection_pool_size'))
+            if config_poolsize > 0:
+                pool_size = config_poolsize
+            else:
+                print (f'\033[31mInvalid connection_pool_size from config file; using default: {DEFAULT_POOL_SIZE}\033[0m')
+        except:
+            pass
+        
+        try:
+            pool_idle = float(parser.get('config', 'connection_idle_timeout'))
         except:
             pass
         
@@ -589,13 +4014,80 @@ def process_config(config_filename):
         except:
             print ('Using output config defaults')
             
-    log = logger(conoutp, logoutp, LOGFILE, False)
+        try:
+            logmaxbytes = int(float(parser.get('config', 'logfile_max_size')) * 1024 * 1024)
+        except:
+            pass
+        
+        try:
+            logrotatesecs = int(float(parser.get('config', 'logfile_rotate_hours')) * 3600)
+        except:
+            pass
+        
+        try:
+            logbackups = int(parser.get('config', 'logfile_backups'))
+        except:
+            pass
+        
+        try:
+            logqueuesize = int(parser.get('config', 'log_queue_size'))
+        except:
+            pass
+        
+        try:
+            config_level = parser.get('config', 'log_level').lower()
+            if config_level in logger.LEVELS:
+                loglevel = logger.LEVELS[config_level]
+            else:
+                print ('\033[31mInvalid log_level from config file; using default: info\033[0m')
+        except:
+            pass
+            
+    if len(sys.argv) > 1:
+        if sys.argv[1] == '-d':
+            loglevel = logger.DEBUG
+            
+    log = logger(conoutp, logoutp, LOGFILE, False, logmaxbytes, logrotatesecs, logbackups, logqueuesize, loglevel)
+    outbound = sessionpool(pool_size, pool_idle)
+    hubstatus = hubhealth(hub_failures, hub_open_secs, hub_scrub_secs)
+    fwpolicy = forwardpolicy(FW_CONNECT_TIMEOUT, FWTIMEOUT, forward_retries, forward_hedge_after,
+                             {host: (connect or FW_CONNECT_TIMEOUT, read) for host, (connect, read) in forward_hosts.items()})
+    
+    hubqueue = None
+    if queue_enabled:
+        spoolfile = os.getcwd() + os.path.sep + SPOOLFILENAME if queue_spool else None
+        hubqueue = deliveryqueue(queue_depth, queue_retries, queue_backoff, spoolfile)
     
 
 #################################################################################################
 ##                  MAINLINE
 #################################################################################################
 
+def local_ip():
+    
+    # The LAN address to show when Server_IP is not configured, found without sending anything: the
+    # address of the interface holding the default route (Linux), else a non-loopback address the
+    # host name maps to
+    
+    try:
+        with open('/proc/net/route') as f:
+            iface = next(fields[0] for fields in (line.split() for line in f) if fields[1:2] == ['00000000'])
+        import fcntl, struct
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            request = struct.pack('256s', iface[:15].encode())
+            return socket.inet_ntoa(fcntl.ioctl(s.fileno(), 0x8915, request)[20:24])      # SIOCGIFADDR
+    except (OSError, StopIteration, ImportError):
+        pass
+        
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            if not ipaddress.ip_address(info[4][0]).is_loopback:
+                return info[4][0]
+    except OSError:
+        pass
+    return '127.0.0.1'
+
+
 if __name__ == '__main__':
 
     thisOS = platform.system()
@@ -605,31 +4097,74 @@ if __name__ == '__main__':
 
 
     process_config(CONFIGFILENAME)
-    registrations = read_regs(REGSFILENAME)
 
     HandlerClass = myHTTPRequestHandler
-    ServerClass = http.server.HTTPServer
 
+    # The server listens before the registrations are loaded, so that connections arriving meanwhile
+    # wait in the listen backlog rather than being refused; none is answered until they are loaded
     try:
-        httpd = ServerClass((str(SERVER_IP), SERVER_PORT), HandlerClass)
+        if SERVER_ENGINE == 'asyncio':
+            loop = asyncio.new_event_loop()
+            httpd = asyncBridge((str(SERVER_IP), SERVER_PORT), outbound.idle_timeout)
+            loop.run_until_complete(httpd.start())
+            enginedesc = 'asyncio engine'
+        else:
+            httpd = create_server((str(SERVER_IP), SERVER_PORT), HandlerClass, SERVER_THREADS)
+            enginedesc = f'{SERVER_THREADS} worker thread(s)'
     except OSError as error :
         log.error (f'ERROR: cannot initialize Server; {error}')
         log.warn (f'Invalid IP address or Port {SERVER_PORT} may be in use by another application\n')
         httpd = False
 
     if httpd:
+        if SERVER_ENGINE != 'asyncio':
+            # import requests in the background while the registrations load, rather than on the first forward
+            threading.Thread(target=requests.load, name='preload', daemon=True).start()
+            
+        registrations = read_regs(REGSFILENAME)
+        regsjournal = regjournal(REGSFILENAME)
+        if regsjournal.journal.tell():
+            regsjournal.compact()       # fold any journal left by the last run into the snapshot
+            
         if SERVER_IP == '':
-            # Trick to get our IP address
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            SERVER_IP =  s.getsockname()[0]
-            s.close()
+            SERVER_IP = local_ip()
 
         log.hilite (f"Forwarding Bridge Server v{VERSION} (for SmartThings Edge)")
-        log.hilite (f" > Serving HTTP on {SERVER_IP}:{SERVER_PORT}")
+        log.hilite (f" > Serving HTTP on {SERVER_IP}:{SERVER_PORT} ({enginedesc})")
 
         try: 
-            httpd.serve_forever()    # wait for, and process HTTP requests
+            if SERVER_ENGINE == 'asyncio':
+                loop.run_until_complete(httpd.serve_forever())
+            else:
+                httpd.serve_forever()    # wait for, and process HTTP requests
 
         except KeyboardInterrupt:
             log.warn ('INFO: Application interrupted by user...\n')
+            
+        if fwcache:
+            log.info (f'Forward response cache: {fwcache.stats()}')
+        log.info (f'Forward coalescing: {coalescer.stats()}')
+        log.info (f'Forward retries and hedging: {fwpolicy.stats()}')
+        fwpolicy.close()
+        if clientlimits:
+            log.info (f'Forward rate limit per client: {clientlimits.stats()}')
+        if hostlimits:
+            log.info (f'Forward rate limit per upstream host: {hostlimits.stats()}')
+        hubbatches.flush()
+        if hubbatches.counts['received']:
+            log.info (f'Hub message batching: {hubbatches.stats()}')
+        if hubqueue:
+            log.info (f'Hub delivery queue: {hubqueue.stats()}')
+            hubqueue.close()
+        if SERVER_ENGINE == 'asyncio':
+            log.info (f'Outbound connection pool: {httpd.client.stats()}')
+            loop.run_until_complete(httpd.stop())
+            loop.close()
+        else:
+            httpd.server_close()
+            log.info (f'Outbound connection pool: {outbound.stats()}')
+            outbound.close()
+            
+    if regsjournal:
+        regsjournal.close()
+    log.close()
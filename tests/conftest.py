@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import edgebridge
+
+
+@pytest.fixture(scope='session', autouse=True)
+def logging_off():
+
+    edgebridge.log = edgebridge.logger(False, False, '', True)
+    yield
+    edgebridge.log.close()
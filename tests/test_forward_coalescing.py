@@ -0,0 +1,153 @@
+# Bursts of identical simultaneous GET forwards, against the in-process server and a local
+# stand-in for the internet server: they should cause a single upstream request.
+
+import http.client
+import http.server
+import socket
+import threading
+import time
+
+import pytest
+
+import edgebridge
+import edgebridge_bench
+
+BURST = 10
+LATENCY = 0.5                           # long enough for the whole burst to arrive while the first is in flight
+
+
+class upstreamHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        upstream = self.server
+        with upstream.lock:
+            upstream.calls += 1
+        time.sleep(LATENCY)
+        self.send_response(upstream.status)
+        self.send_header('Content-Length', str(len(upstream.body)))
+        self.end_headers()
+        self.wfile.write(upstream.body)
+
+    def log_message(self, format, *args):
+        return
+
+
+@pytest.fixture
+def upstream():
+
+    server = edgebridge_bench.standinServer(('127.0.0.1', 0), upstreamHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls = 0
+    server.status = 200
+    server.body = b'{"reading": 42}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['16', 'asyncio'])           # more worker threads than BURST, so all are in flight at once
+def bridge(request):
+
+    edgebridge.FORWARD_COALESCING = True
+    edgebridge.fwcache = None
+    edgebridge.coalescer = edgebridge.singleflight()
+    bridge = edgebridge_bench.start_bridge(request.param)
+    yield bridge
+    bridge.stop()
+    edgebridge.fwcache = None
+
+
+def burst(bridge, url, size=BURST):
+
+    # Returns the (status, body) of each of size identical forwards sent at the same moment
+
+    barrier = threading.Barrier(size)
+    results = []
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', bridge.port, timeout=30)
+        barrier.wait()
+        conn.request('GET', f'/api/forward?url={url}')
+        resp = conn.getresponse()
+        results.append((resp.status, resp.read()))
+        conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_burst_makes_one_upstream_request(bridge, upstream):
+
+    results = burst(bridge, f'http://127.0.0.1:{upstream.server_address[1]}/sensor')
+
+    assert upstream.calls == 1
+    assert results == [(200, upstream.body)] * BURST
+    assert edgebridge.coalescer.stats() == {'upstream': 1, 'coalesced': BURST - 1}
+
+
+def test_upstream_error_is_shared_and_not_kept(bridge, upstream):
+
+    edgebridge.fwcache = edgebridge.responsecache(60, 16)
+    url = f'http://127.0.0.1:{upstream.server_address[1]}/sensor'
+
+    upstream.status = 503
+    results = burst(bridge, url)
+    assert upstream.calls == 1
+    assert len(set(results)) == 1 and results[0][0] == 503
+
+    upstream.status = 200
+    results = burst(bridge, url)
+    assert upstream.calls == 2
+    assert results == [(200, upstream.body)] * BURST
+
+
+def test_connection_failure_is_shared_and_not_kept(bridge):
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()                        # nothing listening: every attempt is refused
+
+    results = burst(bridge, f'http://127.0.0.1:{port}/sensor')
+    assert results == [(502, b'')] * BURST
+    upstream = edgebridge.coalescer.stats()['upstream']
+
+    results = burst(bridge, f'http://127.0.0.1:{port}/sensor')
+    assert results == [(502, b'')] * BURST
+    assert edgebridge.coalescer.stats()['upstream'] > upstream
+
+
+def test_waiter_keeps_its_own_deadline(bridge, upstream):
+
+    # The first request has the default deadline; one sent with timeout=0.2 while it is in flight
+    # shares its upstream request, but still gets a 504 when its own deadline passes
+    url = f'http://127.0.0.1:{upstream.server_address[1]}/sensor'
+    results = {}
+
+    def forward(name, query):
+        conn = http.client.HTTPConnection('127.0.0.1', bridge.port, timeout=30)
+        start = time.monotonic()
+        conn.request('GET', f'/api/forward?{query}url={url}')
+        resp = conn.getresponse()
+        results[name] = (resp.status, resp.read(), time.monotonic() - start)
+        conn.close()
+
+    leader = threading.Thread(target=forward, args=('leader', ''))
+    leader.start()
+    time.sleep(0.1)
+    forward('waiter', 'timeout=0.2&')
+    leader.join()
+
+    assert results['leader'][:2] == (200, upstream.body)
+    assert results['waiter'][0] == 504
+    assert results['waiter'][2] < LATENCY
+    assert upstream.calls == 1
@@ -0,0 +1,49 @@
+# Forward rate limits, against the in-process server: a client over its limit is refused before
+# it sends its request body.
+
+import socket
+
+import pytest
+
+import edgebridge
+import edgebridge_bench
+
+
+@pytest.fixture(params=['4', 'asyncio'])
+def bridge(request, monkeypatch):
+
+    monkeypatch.setattr(edgebridge, 'clientlimits', edgebridge.ratelimiter(0.001, 2))
+    bridge = edgebridge_bench.start_bridge(request.param)
+    yield bridge
+    bridge.stop()
+
+
+def expect_continue(bridge, port):
+
+    # POSTs a forward with Expect: 100-continue; returns the first status line, and the final one
+    # if the server asked for the body
+
+    sock = socket.create_connection(('127.0.0.1', bridge.port), timeout=10)
+    reader = sock.makefile('rb')
+    sock.sendall(f'POST /api/forward?url=http://127.0.0.1:{port}/x HTTP/1.1\r\nHost: bridge\r\n'
+                 f'Content-Length: 5\r\nExpect: 100-continue\r\n\r\n'.encode('latin-1'))
+    first = reader.readline().strip()
+    final = None
+    if first.startswith(b'HTTP/1.1 100'):
+        reader.readline()
+        sock.sendall(b'hello')
+        final = reader.readline().strip()
+    sock.close()
+    return first, final
+
+
+def test_throttled_before_100_continue(bridge):
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]        # nothing listening: allowed forwards get a 502
+    sock.close()
+
+    for _ in range(2):                  # the burst allowance; each request takes one token only
+        assert expect_continue(bridge, port) == (b'HTTP/1.1 100 Continue', b'HTTP/1.1 502 Bad Gateway')
+    assert expect_continue(bridge, port) == (b'HTTP/1.1 429 Too Many Requests', None)
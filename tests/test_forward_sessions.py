@@ -0,0 +1,76 @@
+# Forwards from different Edge drivers share pooled upstream connections, but nothing an upstream
+# server sets for one of them (cookies) may be sent on behalf of another.
+
+import http.client
+import http.server
+import threading
+
+import pytest
+
+import edgebridge
+import edgebridge_bench
+
+
+class upstreamHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        self.server.cookies[self.path] = self.headers.get('Cookie')
+        self.send_response(200)
+        if self.path == '/login':
+            self.send_header('Set-Cookie', 'session=driverA-secret; Path=/')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        return
+
+
+@pytest.fixture
+def upstream():
+
+    server = edgebridge_bench.standinServer(('127.0.0.1', 0), upstreamHandler)
+    server.daemon_threads = True
+    server.cookies = {}                 # path -> Cookie header received
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['4', 'asyncio'])
+def bridge(request):
+
+    bridge = edgebridge_bench.start_bridge(request.param)
+    yield bridge
+    bridge.stop()
+
+
+def forward(bridge, url, headers={}):
+
+    conn = http.client.HTTPConnection('127.0.0.1', bridge.port, timeout=30)
+    conn.request('GET', f'/api/forward?url={url}', headers=headers)
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    return resp.status
+
+
+def test_upstream_cookies_are_not_shared(bridge, upstream):
+
+    url = f'http://127.0.0.1:{upstream.server_address[1]}'
+
+    assert forward(bridge, f'{url}/login') == 200
+    assert forward(bridge, f'{url}/other-driver') == 200
+    assert upstream.cookies['/other-driver'] is None
+
+
+def test_driver_cookies_are_passed_on(bridge, upstream):
+
+    url = f'http://127.0.0.1:{upstream.server_address[1]}'
+
+    assert forward(bridge, f'{url}/mine', {'Cookie': 'session=driverB'}) == 200
+    assert upstream.cookies['/mine'] == 'session=driverB'
@@ -0,0 +1,131 @@
+# Device messages passed on to registered Edge hubs, against the in-process server and local
+# stand-ins for the hubs.
+
+import http.client
+import http.server
+import socket
+import threading
+import time
+
+import pytest
+
+import edgebridge
+import edgebridge_bench
+
+HUBS = 10                               # more than the hub delivery workers, so some sends wait their turn
+LATENCY = 0.3
+
+
+class hubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.received.append((self.path, body))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_hub(latency):
+
+    server = edgebridge_bench.standinServer(('127.0.0.1', 0), hubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.received = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def hubs():
+
+    servers = [start_hub(LATENCY) for _ in range(HUBS)]
+    yield servers
+    stopping = [threading.Thread(target=server.shutdown) for server in servers]
+    for thread in stopping:
+        thread.start()
+    for thread in stopping:
+        thread.join()
+    for server in servers:
+        server.server_close()
+
+
+@pytest.fixture(params=['4', 'asyncio'])
+def bridge(request, hubs, monkeypatch):
+
+    monkeypatch.setattr(edgebridge, 'registrations', edgebridge.regstore(
+        [edgebridge.registration(('127.0.0.1', None), f'edge{n}', ('127.0.0.1', hub.server_address[1])) for n, hub in enumerate(hubs)]))
+    monkeypatch.setattr(edgebridge, 'hubstatus', edgebridge.hubhealth(edgebridge.DEFAULT_HUB_FAILURES, edgebridge.DEFAULT_HUB_OPEN_SECS,
+                                                                      edgebridge.DEFAULT_HUB_SCRUB_SECS))
+    bridge = edgebridge_bench.start_bridge(request.param)
+    yield bridge
+    bridge.stop()
+
+
+def test_immediate_ack_delivers_each_message(bridge, hubs, monkeypatch):
+
+    # The device's second message on a kept-alive connection arrives while the first is still being
+    # delivered; every hub must get each message once
+    monkeypatch.setattr(edgebridge, 'HUB_ACK_IMMEDIATE', True)
+
+    conn = http.client.HTTPConnection('127.0.0.1', bridge.port, timeout=30)
+    for path in ('/a', '/b'):
+        conn.request('POST', path, body=path.encode(), headers={'Content-Type': 'text/plain'})
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 200
+    conn.close()
+
+    deadline = time.monotonic() + 10
+    while sum(len(hub.received) for hub in hubs) < 2 * HUBS and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(LATENCY)                 # nothing more should arrive
+
+    for hub in hubs:
+        assert sorted(hub.received) == [('/127.0.0.1/POST/a', b'/a'), ('/127.0.0.1/POST/b', b'/b')]
+
+
+def test_spool_stays_small_while_a_hub_is_down(tmp_path, monkeypatch):
+
+    # One hub is unreachable, so its queue never empties; messages to a healthy hub keep coming
+    monkeypatch.setattr(edgebridge, 'hubstatus', edgebridge.hubhealth(edgebridge.DEFAULT_HUB_FAILURES, edgebridge.DEFAULT_HUB_OPEN_SECS,
+                                                                      edgebridge.DEFAULT_HUB_SCRUB_SECS))
+    monkeypatch.setattr(edgebridge, 'registrations', edgebridge.regstore())
+    healthy = start_hub(0)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    down = sock.getsockname()[1]
+    sock.close()
+    spoolfile = str(tmp_path / '.hubspool')
+    deadrecord = edgebridge.registration(('10.0.0.1', None), 'edge-down', ('127.0.0.1', down))
+    liverecord = edgebridge.registration(('10.0.0.2', None), 'edge-up', ('127.0.0.1', healthy.server_address[1]))
+
+    hubqueue = edgebridge.deliveryqueue(100, 3, 5, spoolfile)
+    for n in range(3):
+        assert hubqueue.enqueue(edgebridge.hubmessage('POST', f'/down{n}', {}, b'x'), deadrecord)
+    for n in range(500):
+        while not hubqueue.enqueue(edgebridge.hubmessage('POST', f'/up{n}', {}, b'y' * 1000), liverecord):
+            time.sleep(0.01)            # the healthy hub's queue is full
+    deadline = time.monotonic() + 20
+    while hubqueue.stats()['delivered'] < 500 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    hubqueue.close()
+    healthy.shutdown()
+    healthy.server_close()
+
+    with open(spoolfile) as f:
+        lines = f.readlines()
+    assert hubqueue.stats()['delivered'] == 500
+    assert len(lines) < 4 * 3 + edgebridge.SPOOL_COMPACT_MIN + 2
+    restored = edgebridge.deliveryqueue(100, 3, 5, spoolfile)
+    assert restored.stats()['depth'] == {f'127.0.0.1:{down}': 3}
+    restored.close()